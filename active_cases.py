@@ -0,0 +1,165 @@
+from population import Population, NO_DAY
+import typing as t
+import numpy as np
+
+from settings import *
+
+
+class IndexSet:
+    """
+    A set of people's indexes kept in an array, so it can be handed to NumPy as it is. Each member has a slot in
+    members[:len(self)] and position gives the slot of each person (-1 if not in the set). Removing a person
+    moves the last member into its slot, so adding and removing cost the number of people added or removed.
+    The members are in no particular order
+    """
+    def __init__(self, size: int):
+        """
+        :param size: the number of people who could be in the set
+        """
+        self.members: np.ndarray = np.zeros(16, dtype=np.int64)
+        self.position: np.ndarray = np.full(size, -1, dtype=np.int32)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def array(self) -> np.ndarray:
+        """
+        The members, in no particular order (a view, that changes with the set)
+        :return:
+        """
+        return self.members[:self.count]
+
+    def clear(self):
+        self.position[self.array()] = -1
+        self.count = 0
+
+    def copy(self) -> 'IndexSet':
+        index_set = IndexSet.__new__(IndexSet)
+        index_set.members = self.members.copy()
+        index_set.position = self.position.copy()
+        index_set.count = self.count
+        return index_set
+
+    def add(self, idx: np.ndarray):
+        """
+        :param idx: people to add (the ones already in the set are skipped)
+        :return:
+        """
+        idx = idx[self.position[idx] < 0]
+        if len(idx) > 1:
+            idx = np.unique(idx)
+        if len(idx) == 0:
+            return
+        end = self.count + len(idx)
+        if end > len(self.members):
+            members = np.zeros(max(end, 2 * len(self.members)), dtype=np.int64)
+            members[:self.count] = self.array()
+            self.members = members
+        self.members[self.count:end] = idx
+        self.position[idx] = np.arange(self.count, end)
+        self.count = end
+
+    def discard(self, idx: np.ndarray):
+        """
+        :param idx: people to remove (the ones not in the set are skipped)
+        :return:
+        """
+        slots = self.position[idx]
+        idx, slots = idx[slots >= 0], slots[slots >= 0]
+        if len(idx) > 1:
+            idx, first = np.unique(idx, return_index=True)
+            slots = slots[first]
+        if len(idx) == 0:
+            return
+        self.position[idx] = -1
+        end = self.count - len(idx)
+        # the members left after the new end fill the slots emptied before it
+        tail = self.members[end:self.count]
+        movers = tail[self.position[tail] >= 0]
+        holes = slots[slots < end]
+        self.members[holes] = movers
+        self.position[movers] = holes
+        self.count = end
+
+    def check(self) -> bool:
+        """
+        Whether the members and the positions agree with each other
+        :return:
+        """
+        members = self.array()
+        return (np.array_equal(self.position[members], np.arange(self.count))
+                and np.count_nonzero(self.position >= 0) == self.count)
+
+
+class ActiveCases:
+    """
+    Index of the people who are currently contagious, split into those in quarantine and those still
+    circulating. Like CityStats it is kept up to date by the Population actions (infect, quarantine,
+    recover, kill), so finding the sick people each day costs the number of active cases rather than
+    a scan of the whole population.
+    """
+    def __init__(self, pop: Population):
+        self.pop = pop
+        self.quarantined = IndexSet(len(pop))
+        self.circulating = IndexSet(len(pop))
+        self.reset()
+        pop.observers.append(self)
+
+    def __len__(self) -> int:
+        return len(self.quarantined) + len(self.circulating)
+
+    def reset(self):
+        """
+        Rebuild the index with a full scan (eg. after the population's state was replaced)
+        :return:
+        """
+        self.quarantined.clear()
+        self.circulating.clear()
+        self.after_change(np.flatnonzero(self.pop.is_contagious))
+
+    def clone(self, pop: Population) -> 'ActiveCases':
+        """
+        Copy the index for a copy of the population (see Population.clone)
+        :param pop: the copy of the population
+        :return:
+        """
+        active = ActiveCases.__new__(ActiveCases)
+        active.pop = pop
+        active.quarantined = self.quarantined.copy()
+        active.circulating = self.circulating.copy()
+        pop.observers.append(active)
+        return active
+
+    def before_change(self, idx: t.Union[int, np.ndarray]):
+        idx = np.atleast_1d(idx)
+        self.quarantined.discard(idx)
+        self.circulating.discard(idx)
+
+    def after_change(self, idx: t.Union[int, np.ndarray]):
+        idx = np.atleast_1d(idx)
+        pop = self.pop
+        contagious = pop.is_alive[idx] & (pop.covid_start[idx] != NO_DAY)
+        if not RECOVERED_ARE_CONTAGIOUS:
+            contagious &= pop.covid_end[idx] == NO_DAY
+        in_quarantine = pop.in_quarantine[idx]
+        self.quarantined.add(idx[contagious & in_quarantine])
+        self.circulating.add(idx[contagious & ~in_quarantine])
+
+    def all(self) -> np.ndarray:
+        """
+        Everyone who is contagious, in no particular order
+        :return:
+        """
+        return np.concatenate([self.quarantined.array(), self.circulating.array()])
+
+    def check(self):
+        """
+        Cross-check the index against a full scan of the population
+        :return:
+        """
+        contagious = self.pop.is_contagious
+        for index_set, expected in ((self.quarantined, contagious & self.pop.in_quarantine),
+                                    (self.circulating, contagious & ~self.pop.in_quarantine)):
+            if not index_set.check() or not np.array_equal(np.sort(index_set.array()), np.flatnonzero(expected)):
+                raise AssertionError('Active cases are out of date')
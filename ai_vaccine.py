@@ -1,9 +1,17 @@
 from city import City
-from person import Person
 from vaccine import VaccineBase
+from features import DEFAULT_FEATURES, check_features, feature_columns, feature_matrix, outcome_labels, stack_features
+from replay import ReplayDataset
+from checkpoint import write_atomic
 from settings import *
+from runner import init_worker
+from concurrent.futures import Future, ProcessPoolExecutor
+import collections
+import dataclasses
 import typing as t
+import pathlib
 import time
+import numpy as np
 import torch
 
 
@@ -48,100 +56,320 @@ class COVIDloss(torch.nn.Module):
         return (prediction * actual).mean()
 
 
+@dataclasses.dataclass
+class TrainingJob:
+    """
+    One training city to simulate, scored by a copy of the network as it was when the job was queued
+    """
+    features: t.Tuple[str, ...]
+    state: t.Dict[str, torch.Tensor]    # the network's state_dict
+    size: int
+    initial_sick: int
+    days: int
+    seed: int
+
+    @property
+    def key(self) -> str:
+        """
+        Names the city this job builds (see ReplayDataset)
+        :return:
+        """
+        return f'{self.size}-{self.initial_sick}-{self.days}-{self.seed}'
+
+
+def simulate_training_city(job: TrainingJob) -> t.Dict[str, np.ndarray]:
+    """
+    Build a training city, vaccinate it in the network's order and run it. This is what each worker process does
+    :param job:
+    :return: every feature column (see feature_columns) and the outcomes ('actual', see outcome_labels) of
+             everyone in the city
+    """
+    vaccine = VaccineAI('training', features=job.features)
+    vaccine.nn.load_state_dict(job.state)
+    city = City(name='test', size=job.size, initial_sick=job.initial_sick, seed=job.seed, event_driven=True)
+    vaccine.assign_scores(city)
+    city.run_days(job.days)
+    return {**feature_columns(city), 'actual': outcome_labels(city)}
+
+
+class TrainingData:
+    """
+    Keeps a pool of worker processes simulating training cities in the background. At most queue_size cities are
+    queued (being simulated or waiting to be trained on) at once, and they are handed out in the order they were
+    queued, so a seeded run gives the same cities however many workers there are.
+    Each city is scored with the network as it was when the city was queued, so the training data lags the
+    network by up to queue_size cities. Use as a context manager
+    """
+    def __init__(self, vaccine: 'VaccineAI', workers: t.Optional[int], queue_size: int, seed: t.Optional[int]):
+        """
+        :param vaccine: the vaccine being trained
+        :param workers: number of processes (None for one per core, 1 to simulate each city in this process
+                        when it is needed)
+        :param queue_size: the most cities queued at once
+        :param seed: seed for the training cities (None for random ones)
+        """
+        self.vaccine = vaccine
+        self.queue_size = queue_size
+        self.seeds = np.random.SeedSequence(seed)
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker) if workers != 1 else None
+        self.queue: t.Deque[Future] = collections.deque()
+        self.jobs: t.Deque[TrainingJob] = collections.deque()   # the job of each future in the queue
+
+    def __enter__(self) -> 'TrainingData':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def make_job(self) -> TrainingJob:
+        # Every city gets its own seed, so the ones simulated at the same time in different processes differ
+        seed = int(self.seeds.spawn(1)[0].generate_state(1, dtype=np.uint64)[0])
+        return TrainingJob(
+            features=self.vaccine.features,
+            # a copy, as the optimizer updates the weights in place while the job waits to be sent
+            state={name: value.detach().clone() for name, value in self.vaccine.nn.state_dict().items()},
+            size=self.vaccine.TRAINING_CITY_SIZE,
+            initial_sick=self.vaccine.TRAINING_INITIAL_SICK,
+            days=self.vaccine.TRAINING_DAYS,
+            seed=seed,
+        )
+
+    def state(self) -> t.Dict[str, t.Any]:
+        """
+        Where the training data is up to: the seeds handed out and the jobs queued (see resume)
+        :return: plain values, to save in a checkpoint
+        """
+        return {
+            'entropy': self.seeds.entropy,
+            'spawned': self.seeds.n_children_spawned,
+            'queued': [dataclasses.asdict(job) for job in self.jobs],
+        }
+
+    def resume(self, state: t.Mapping[str, t.Any]):
+        """
+        Carry on from a state(), giving the same cities from then on. Call before next()
+        :param state:
+        :return:
+        """
+        self.seeds = np.random.SeedSequence(state['entropy'], n_children_spawned=state['spawned'])
+        for job in state['queued']:
+            job = TrainingJob(**{**job, 'features': tuple(job['features'])})
+            if self.pool is not None:
+                self.queue.append(self.pool.submit(simulate_training_city, job))
+            self.jobs.append(job)
+
+    def next(self) -> t.Tuple[TrainingJob, t.Dict[str, np.ndarray]]:
+        """
+        The next training city (waits for it to finish if needed)
+        :return: the job and what simulate_training_city gave for it
+        """
+        if self.pool is None:
+            # the jobs queued before a resume come first
+            job = self.jobs.popleft() if len(self.jobs) > 0 else self.make_job()
+            return job, simulate_training_city(job)
+        while len(self.queue) < self.queue_size:
+            job = self.make_job()
+            self.queue.append(self.pool.submit(simulate_training_city, job))
+            self.jobs.append(job)
+        return self.jobs.popleft(), self.queue.popleft().result()
+
+    def close(self):
+        if self.pool is not None:
+            for future in self.queue:
+                future.cancel()
+            self.queue.clear()
+            self.jobs.clear()
+            self.pool.shutdown()
+            self.pool = None
+
+
 class VaccineAI(VaccineBase):
-    INPUT_FEATURES = 6
+    INPUT_FEATURES = len(DEFAULT_FEATURES)
     HIDDEN_FEATURES = INPUT_FEATURES*3
     HIDDEN_LAYERS = 3
     TRAINING_CITY_SIZE = 1000
     TRAINING_INITIAL_SICK = 100
     TRAINING_DAYS = 180
 
-    def __init__(self, vaccine_name: str):
+    def __init__(self, vaccine_name: str, features: t.Sequence[str] = DEFAULT_FEATURES):
+        """
+        :param vaccine_name:
+        :param features: the inputs of the network, names from features.FEATURES (a saved network only loads
+                         with the features it was trained on)
+        """
         super().__init__(vaccine_name)
+        check_features(features)
+        self.features = tuple(features)
         self.nn = PredictorNN(
-            input_features=self.INPUT_FEATURES,
-            hidden_features=self.HIDDEN_FEATURES,
+            input_features=len(self.features),
+            hidden_features=len(self.features)*3,
             hidden_layers=self.HIDDEN_LAYERS
         )
 
-    def train(self, max_cycles: int = 100):
+    def train(self, max_cycles: int = 100, workers: int = 1, cities_per_cycle: int = 1,
+              queue_size: t.Optional[int] = None, seed: t.Optional[int] = None,
+              replay: t.Optional[ReplayDataset] = None, fresh_per_cycle: t.Optional[int] = None,
+              checkpoint: t.Optional[pathlib.Path] = None, checkpoint_every: int = 10, top_up_every: int = 1):
+        """
+        Train the network on simulated cities
+        :param max_cycles: number of optimizer steps
+        :param workers: number of processes simulating training cities in the background (None for one per core,
+                        1 to simulate them in this process, one after the other)
+        :param cities_per_cycle: number of cities in the minibatch of each optimizer step
+        :param queue_size: the most cities being simulated or waiting to be trained on (default: two cycles worth)
+        :param seed: seed for the training cities and for picking cities from the replay (None for random ones)
+        :param replay: where to save the simulated cities and pick earlier ones from to fill up the minibatches
+        :param fresh_per_cycle: how many cities of each minibatch are newly simulated when there is a replay
+                                (default: all of them, 0 to only train on the cities already in the replay)
+        :param checkpoint: a file to save the training to every checkpoint_every cycles (see save_checkpoint). If the
+                           file is already there, training carries on from it, with the same results as if it had
+                           never stopped (given the same arguments). It is deleted once training finishes
+        :param checkpoint_every: cycles between checkpoints
+        :param top_up_every: with a replay, only simulate new cities every this many cycles (starting with the first
+                             one). The cycles in between train on cities from the replay only
+        :return:
+        """
+        fresh_per_cycle = cities_per_cycle if replay is None or fresh_per_cycle is None else fresh_per_cycle
+        if fresh_per_cycle == 0 and (replay is None or len(replay) == 0):
+            raise ValueError('No cities to train on: the replay is empty and no new cities are simulated')
+        if top_up_every < 1:
+            raise ValueError(f'top_up_every has to be at least 1, not {top_up_every}')
+        replay_rng = np.random.default_rng(seed)
         print(f"Training {self.name} for {max_cycles} cycles")
         self.nn.train()
         optimizer = torch.optim.Adam(self.nn.parameters(), lr=0.01)
         loss_fn = COVIDloss()
         train_start_time = time.perf_counter()
-        for cycle in range(max_cycles):
-            start_time = time.perf_counter()
-
-            # Make a random city
-            city = City(name='test', size=self.TRAINING_CITY_SIZE, initial_sick=self.TRAINING_INITIAL_SICK)
-            self.assign_scores(city)
-            for _ in range(self.TRAINING_DAYS):
-                city.run_timestep()
-
-            # Training cycle
-            x = self.get_inputs(city)
-            actual = self.get_actual(city)
-            optimizer.zero_grad()
-            pred = self.nn(x)
-            loss = loss_fn(pred, actual)
-            loss.backward()
-            optimizer.step()
-
-            cycle_time = time.perf_counter() - start_time
-            average_time = (time.perf_counter() - train_start_time)/(cycle + 1)
-            remaining_time = average_time * (max_cycles - cycle)
-            print(
-                f"Cycle: {cycle}\t"
-                f"loss: {loss.item()}\t"
-                f"Time: {cycle_time:0.2f} sec\t"
-                f"Remaining: {remaining_time/60:0.1f} min"
-            )
+        with TrainingData(self, workers, queue_size or max(2*fresh_per_cycle, 1), seed) as training_data:
+            first_cycle = 0
+            if checkpoint is not None and checkpoint.exists():
+                first_cycle = self.load_checkpoint(checkpoint, optimizer, training_data, replay_rng, replay)
+                print(f"Carrying on from cycle {first_cycle}")
+            for cycle in range(first_cycle, max_cycles):
+                start_time = time.perf_counter()
+
+                # Minibatch of newly simulated cities, topped up from the replay (without the cities just added to it,
+                # which are already in the minibatch)
+                fresh = fresh_per_cycle if replay is None or cycle % top_up_every == 0 else 0
+                batch = []
+                added = set()
+                for _ in range(fresh):
+                    job, columns = training_data.next()
+                    if replay is not None:
+                        replay.add(job.key, columns)
+                        added.add(job.key)
+                    batch.append(columns)
+                if replay is not None:
+                    batch += replay.sample(replay_rng, cities_per_cycle - fresh, exclude=added)
+                x = torch.from_numpy(np.concatenate([stack_features(columns, self.features) for columns in batch]))
+                actual = torch.from_numpy(np.concatenate([columns['actual'] for columns in batch]))
+
+                # Training cycle
+                optimizer.zero_grad()
+                pred = self.nn(x).view(-1)
+                loss = loss_fn(pred, actual)
+                loss.backward()
+                optimizer.step()
+
+                if checkpoint is not None and (cycle + 1) % checkpoint_every == 0 and cycle + 1 < max_cycles:
+                    self.save_checkpoint(checkpoint, optimizer, cycle + 1, training_data, replay_rng, replay)
+
+                cycle_time = time.perf_counter() - start_time
+                average_time = (time.perf_counter() - train_start_time)/(cycle + 1 - first_cycle)
+                remaining_time = average_time * (max_cycles - cycle)
+                print(
+                    f"Cycle: {cycle}\t"
+                    f"loss: {loss.item()}\t"
+                    f"Time: {cycle_time:0.2f} sec\t"
+                    f"Remaining: {remaining_time/60:0.1f} min"
+                )
+        if checkpoint is not None:
+            # finished, so the next training starts from scratch rather than from the last cycle
+            checkpoint.unlink(missing_ok=True)
+
+    def save_checkpoint(self, path: pathlib.Path, optimizer: torch.optim.Optimizer, cycle: int,
+                        training_data: TrainingData, replay_rng: np.random.Generator,
+                        replay: t.Optional[ReplayDataset]):
+        """
+        Save everything train needs to carry on: the network, the optimizer, the number of cycles done, where the
+        training cities are up to and the cities in the replay. Written with torch.save, replacing the file at once
+        :param path:
+        :param optimizer:
+        :param cycle: the next cycle to run
+        :param training_data:
+        :param replay_rng: picks the cities from the replay
+        :param replay:
+        :return:
+        """
+        state = {
+            'nn': self.nn.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'cycle': cycle,
+            'training_data': training_data.state(),
+            'replay_rng': replay_rng.bit_generator.state,
+            'replay_keys': list(replay.keys) if replay is not None else None,
+        }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(path, lambda file: torch.save(state, file))
+
+    def load_checkpoint(self, path: pathlib.Path, optimizer: torch.optim.Optimizer, training_data: TrainingData,
+                        replay_rng: np.random.Generator, replay: t.Optional[ReplayDataset]) -> int:
+        """
+        Put the training back to where it was when save_checkpoint was called
+        :param path:
+        :param optimizer: see save_checkpoint
+        :param training_data:
+        :param replay_rng:
+        :param replay:
+        :return: the next cycle to run
+        """
+        state = torch.load(path)
+        self.nn.load_state_dict(state['nn'])
+        optimizer.load_state_dict(state['optimizer'])
+        training_data.resume(state['training_data'])
+        replay_rng.bit_generator.state = state['replay_rng']
+        if replay is not None and state['replay_keys'] is not None:
+            # cities added since the checkpoint are added again in the same order (cities deleted since then to make
+            # room can't be picked)
+            replay.keys = [key for key in state['replay_keys'] if replay.file(key).exists()]
+        return state['cycle']
 
     def assign_scores(self, city: City):
-        scores: t.List[float] = self.get_prediction(city)
-        person: Person
-        for idx, person in enumerate(city.pop):
-            person.vaccine_score = scores[idx]
+        self.get_prediction(city, out=city.pop.vaccine_score)
 
     def get_inputs(self, city: City) -> torch.Tensor:
-        x: torch.Tensor = torch.zeros(size=(len(city.pop), self.INPUT_FEATURES))
-        person: Person
-        for idx, person in enumerate(city.pop):
-            person_row = torch.as_tensor([
-                float(person.age),
-                float(person.is_teacher),
-                float(person.is_frontline_worker),
-                float(person.is_hospital_worker),
-                float(person.preexisting_condition),
-                float(len(person.shopping)),
-            ])
-            x[idx] = person_row
-        return x
+        return torch.from_numpy(feature_matrix(city, self.features))
 
     def get_actual(self, city: City) -> torch.Tensor:
-        x: torch.Tensor = torch.zeros(size=(len(city.pop),))
-        person: Person
-        for idx, person in enumerate(city.pop):
-            if person.initially_sick:
-                val = 0   # Ignore these people
-            elif person.is_alive is False:
-                val = 2   # Extra penalty for death
-            elif person.was_sick:
-                val = 1   # Penalty for getting sick
-            else:
-                val = -1  # Benefit for not getting sick
-            x[idx] = val
-        return x
-
-    def get_prediction(self, city: City) -> t.List[float]:
+        return torch.from_numpy(outcome_labels(city))
+
+    def get_prediction(self, city: City, out: t.Optional[np.ndarray] = None, batch_size: int = inference_batch_size,
+                       threads: t.Optional[int] = inference_threads) -> np.ndarray:
+        """
+        Score everyone in the city, batch_size people at a time, so however big the city is only one batch of inputs
+        (and of the network's activations) is held at once
+        :param city:
+        :param out: an array (size: pop) to write the scores into (eg. city.pop.vaccine_score), or None for a new one
+        :param batch_size: the number of people scored at a time
+        :param threads: the most threads torch can use while scoring (None for as many as it is already set to)
+        :return: the scores (out, if given)
+        """
+        scores = np.empty(len(city.pop), dtype=np.float64) if out is None else out
         old_mode = self.nn.training
-        x: torch.Tensor = self.get_inputs(city)
-        with torch.no_grad():
-            self.nn.eval()
-            pred = self.nn(x).view(-1).tolist()
-        self.nn.train(mode=old_mode)
-        return pred
+        old_threads = torch.get_num_threads()
+        if threads is not None:
+            torch.set_num_threads(min(threads, old_threads))
+        self.nn.eval()
+        try:
+            with torch.inference_mode():
+                for start in range(0, len(scores), batch_size):
+                    people = slice(start, min(start + batch_size, len(scores)))
+                    x = torch.from_numpy(feature_matrix(city, self.features, people))
+                    scores[people] = self.nn(x).view(-1).numpy()
+        finally:
+            torch.set_num_threads(old_threads)
+            self.nn.train(mode=old_mode)
+        return scores
 
     def save_nn(self):
         model_path = output_dir / f"{self.name}.dat"
@@ -0,0 +1,200 @@
+from city import City
+from vaccine import RandomVaccine
+from report import create_summary_dictionary
+from sinks import CsvSink
+from metrics import CityMetrics
+from datetime import datetime
+import typing as t
+import argparse
+import json
+import pathlib
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import scipy
+
+
+# The cities that are benchmarked: (size, vectorized). The looping version is too slow for the big ones
+CASES: t.Tuple[t.Tuple[int, bool], ...] = (
+    (1_000, False),
+    (10_000, False),
+    (1_000, True),
+    (10_000, True),
+    (100_000, True),
+    (1_000_000, True),
+)
+PHASES = ('early', 'peak', 'late')      # before, around and after the most people are sick
+PEAK_FRACTION = 0.5                     # days with at least this fraction of the most people sick are the peak
+
+
+def case_name(size: int, vectorized: bool) -> str:
+    return f"{'vectorized' if vectorized else 'loop'}-{size}"
+
+
+def split_phases(sick: t.List[int]) -> t.List[str]:
+    """
+    Label each day with its phase of the epidemic
+    :param sick: the number of people sick on each day
+    :return: one of PHASES for each day
+    """
+    sick = np.asarray(sick)
+    peak_day = int(np.argmax(sick))
+    at_peak = sick >= PEAK_FRACTION * sick[peak_day]
+    days = np.arange(len(sick))
+    return np.where(at_peak, 'peak', np.where(days < peak_day, 'early', 'late')).tolist()
+
+
+def benchmark_city(size: int, vectorized: bool, days: int, seed: int) -> t.Dict:
+    """
+    Time everything a trial does on one seeded city
+    :param size: number of people
+    :param vectorized: see City
+    :param days: number of days to run
+    :param seed: see City
+    :return: the timings (seconds), see README
+    """
+    start_time = time.perf_counter()
+    city = City(name='benchmark', size=size, initial_sick=max(10, size // 1000), vectorized=vectorized, seed=seed)
+    init_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    city.build_helpers()
+    build_helpers_time = time.perf_counter() - start_time
+    RandomVaccine('random_vaccine').assign_scores(city)
+
+    city.metrics = CityMetrics()
+    sick = []
+    summaries = []
+    for _ in range(days):
+        city.run_timestep()
+        sick.append(city.num_sick)
+        with city.measure('summary_dictionary'):
+            summaries.append(create_summary_dictionary(city))
+    steps = [name for name in city.metrics.totals if name.startswith('step')]
+    step_timings = [{step: row.get(step, 0.0) for step in steps} for row in city.metrics.rows]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start_time = time.perf_counter()
+        with CsvSink(pathlib.Path(temp_dir), 'benchmark', 'random_vaccine', 0) as sink:
+            for summary in summaries:
+                sink.add_summary(summary)
+            summary_csv_time = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            sink.add_people(city)
+            person_csv_time = time.perf_counter() - start_time
+
+    # Average time a day of each step, in each phase
+    phase_of_day = split_phases(sick)
+    phases = {}
+    for phase in PHASES:
+        in_phase = [timings for timings, day_phase in zip(step_timings, phase_of_day) if day_phase == phase]
+        if len(in_phase) > 0:
+            phases[phase] = {
+                'days': len(in_phase),
+                **{step: float(np.mean([timings[step] for timings in in_phase])) for step in in_phase[0]},
+            }
+    return {
+        'init': init_time,
+        'build_helpers': build_helpers_time,
+        'timestep': float(sum(sum(timings.values()) for timings in step_timings) / days),
+        'phases': phases,
+        'summary_dictionary': city.metrics.totals['summary_dictionary'] / days,
+        'summary_csv': summary_csv_time,
+        'person_csv': person_csv_time,
+        'peak_sick': int(max(sick)),
+    }
+
+
+def run_benchmarks(cases: t.Sequence[t.Tuple[int, bool]], days: int, seed: int) -> t.Dict:
+    """
+    Benchmark each case
+    :param cases: (size, vectorized) pairs
+    :param days: number of days to run each city
+    :param seed: seed for every city
+    :return: the results, ready to save as JSON
+    """
+    results = {}
+    for size, vectorized in cases:
+        name = case_name(size, vectorized)
+        print(f'Benchmarking {name}...', end='', flush=True)
+        results[name] = benchmark_city(size, vectorized, days, seed)
+        print(f" {results[name]['timestep'] * 1000:0.2f} ms a day")
+    return {
+        'info': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'machine': platform.machine(),
+            'days': days,
+            'seed': seed,
+        },
+        'results': results,
+    }
+
+
+def flatten(timings: t.Dict, prefix: str = '') -> t.Dict[str, float]:
+    """
+    Turn nested timings into {'a/b/c': seconds}, leaving out the counts
+    :param timings:
+    :param prefix:
+    :return:
+    """
+    flat = {}
+    for key, value in timings.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}/'))
+        elif isinstance(value, float):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(results: t.Dict, baseline: t.Dict, tolerance: float, min_time: float) -> t.List[str]:
+    """
+    Compare results with a baseline, printing the ratio of every timing they both have
+    :param results: from run_benchmarks
+    :param baseline: from run_benchmarks, on an earlier version
+    :param tolerance: a timing more than this many times slower than the baseline is a regression
+    :param min_time: timings under this many seconds (in both) are too noisy to count as regressions
+    :return: the timings that regressed
+    """
+    for setting in ('days', 'seed'):
+        if results['info'][setting] != baseline['info'][setting]:
+            print(f"Warning: the baseline was run with {setting}={baseline['info'][setting]}, "
+                  f"not {results['info'][setting]}, so the timings don't compare")
+    new, old = flatten(results['results']), flatten(baseline['results'])
+    regressions = []
+    for key in sorted(new.keys() & old.keys()):
+        ratio = new[key] / old[key] if old[key] > 0 else float('inf')
+        regressed = ratio > tolerance and max(new[key], old[key]) >= min_time
+        print(f"{key:60s} {old[key] * 1000:10.3f} ms -> {new[key] * 1000:10.3f} ms  x{ratio:0.2f}"
+              f"{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the COVID 19 simulator')
+    parser.add_argument('--sizes', type=int, nargs='*', help='only benchmark cities of these sizes')
+    parser.add_argument('--days', type=int, default=365, help='number of days to run each city')
+    parser.add_argument('--seed', type=int, default=0, help='seed for every city')
+    parser.add_argument('--output', type=pathlib.Path, help='save the results to this JSON file')
+    parser.add_argument('--baseline', type=pathlib.Path, help='compare with the results in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='slowdown that counts as a regression')
+    parser.add_argument('--min-time', type=float, default=1e-3, help='ignore regressions in timings under this')
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmarks(
+        cases=[case for case in CASES if args.sizes is None or case[0] in args.sizes],
+        days=args.days,
+        seed=args.seed,
+    )
+    if args.output is not None:
+        args.output.write_text(json.dumps(benchmark_results, indent=2) + '\n')
+    if args.baseline is not None:
+        regressed = compare(benchmark_results, json.loads(args.baseline.read_text()), args.tolerance, args.min_time)
+        if len(regressed) > 0:
+            print(f'{len(regressed)} timings regressed')
+            sys.exit(1)
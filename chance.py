@@ -0,0 +1,111 @@
+import settings
+import typing as t
+import bisect
+import math
+import numpy as np
+
+
+# How much more likely people are to catch covid from the same interactions
+AGE_BRACKETS = (30, 50, 70)             # the youngest age in each bracket after the first
+AGE_FACTORS = (1.0, 1.1, 1.5, 2.0)      # one for each bracket, youngest first
+PREEXISTING_CONDITION_FACTOR = 2.0
+TABLE_SIZE = 1 << 16                    # entries for each risk group (counts above that are computed directly)
+
+
+class ChanceTable:
+    """
+    The chance of getting covid after a number of interactions, for each risk group (age bracket and
+    pre-existing condition), worked out ahead of time for every interaction count up to a limit.
+
+    The interaction counts are all multiples of the gcd of the WORK/HOME/SHOPPING_INTERACTIONS settings, so
+    the table only holds those. Counts that are past the end of the table or not a multiple are computed
+    directly. The chance for n interactions is (1 + c) ** n - 1, which is computed as expm1(n * log1p(c))
+    so it stays accurate for the tiny chance c of one interaction
+    """
+    def __init__(self, chance_per_interaction: float, interactions: t.Sequence[int], size: int = TABLE_SIZE):
+        """
+        :param chance_per_interaction: see settings.CHANGE_OF_GETTING_SICK_FROM_INTERACTION
+        :param interactions: the number of interactions people have in each place (see settings)
+        :param size: number of entries for each risk group
+        """
+        self.log_chance = math.log1p(chance_per_interaction)
+        self.step = max(1, math.gcd(*interactions))
+        base = np.expm1(np.arange(size) * self.step * self.log_chance)
+
+        # table[group, n // step], with group = age bracket * 2 + pre-existing condition
+        preexisting_factor = np.array([1.0, PREEXISTING_CONDITION_FACTOR])
+        by_age = base[np.newaxis, :] * np.array(AGE_FACTORS)[:, np.newaxis]
+        self.table = (by_age[:, np.newaxis, :] * preexisting_factor[np.newaxis, :, np.newaxis]).reshape(-1, size)
+
+    def chance(self, interactions: int, age: int, preexisting_condition: bool, covid_immunity: float) -> float:
+        """
+        The chance of getting covid for one person
+        :param interactions: the number of interactions the person had with sick people
+        :param age:
+        :param preexisting_condition:
+        :param covid_immunity: 0 = vulnerable, 1 = immune
+        :return:
+        """
+        group = bisect.bisect_right(AGE_BRACKETS, age) * 2 + int(preexisting_condition)
+        column, remainder = divmod(interactions, self.step)
+        if remainder == 0 and column < self.table.shape[1]:
+            probability = float(self.table[group, column])
+        else:
+            # np.expm1 rather than math.expm1, which can differ in the last bit, so this matches lookup
+            probability = float(np.expm1(interactions * self.log_chance)) * AGE_FACTORS[group // 2]
+            probability *= PREEXISTING_CONDITION_FACTOR if preexisting_condition else 1.0
+
+        # Adjust for immunity factor
+        return probability * (1 - covid_immunity)
+
+    @staticmethod
+    def risk_group(age: np.ndarray, preexisting_condition: np.ndarray) -> np.ndarray:
+        return np.searchsorted(AGE_BRACKETS, age, side='right') * 2 + preexisting_condition
+
+    def lookup(self, interactions: np.ndarray, age: np.ndarray, preexisting_condition: np.ndarray,
+               covid_immunity: np.ndarray) -> np.ndarray:
+        """
+        The chance of getting covid for a number of people
+        :param interactions: the number of interactions each person had with sick people
+        :param age:
+        :param preexisting_condition:
+        :param covid_immunity: 0 = vulnerable, 1 = immune
+        :return: an array of probabilities
+        """
+        interactions = np.asarray(interactions)
+        group = self.risk_group(age, preexisting_condition)
+        column, remainder = np.divmod(interactions, self.step)
+        in_table = (remainder == 0) & (column < self.table.shape[1])
+        probability = self.table[group, np.where(in_table, column, 0)]
+        if not in_table.all():
+            outside = ~in_table
+            probability[outside] = (
+                np.expm1(interactions[outside] * self.log_chance)
+                * np.take(AGE_FACTORS, group[outside] // 2)
+                * np.where(group[outside] % 2 == 1, PREEXISTING_CONDITION_FACTOR, 1.0)
+            )
+
+        # Adjust for immunity factor
+        return probability * (1 - covid_immunity)
+
+
+_table: t.Optional[ChanceTable] = None
+_table_settings: t.Optional[tuple] = None
+
+
+def chance_table() -> ChanceTable:
+    """
+    The table for the current settings. It is rebuilt if any of the settings it depends on have changed
+    :return:
+    """
+    global _table, _table_settings
+    current_settings = (
+        settings.CHANGE_OF_GETTING_SICK_FROM_INTERACTION,
+        settings.WORK_INTERACTIONS,
+        settings.HOME_INTERACTIONS,
+        settings.SHOPPING_INTERACTIONS,
+    )
+    if _table is None or current_settings != _table_settings:
+        _table = ChanceTable(current_settings[0], current_settings[1:])
+        _table_settings = current_settings
+    return _table
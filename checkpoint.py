@@ -0,0 +1,102 @@
+from city import City, CitySnapshot
+from datetime import date
+import typing as t
+import pathlib
+import json
+import os
+import numpy as np
+
+
+def write_atomic(path: pathlib.Path, write: t.Callable[[t.BinaryIO], None]):
+    """
+    Write a file so that it is either all there or not changed at all: write a temporary file next to it, flush it
+    to disk, then rename it over the old one
+    :param path:
+    :param write: writes the contents to the open file it is given
+    :return:
+    """
+    temp_path = path.with_name(f'{path.name}.tmp')
+    with temp_path.open('wb') as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def run_info(city: City, days: int) -> t.Dict:
+    """
+    What a checkpoint has to match to be carried on from: how the city was made and how long it runs for
+    :param city:
+    :param days:
+    :return:
+    """
+    return {
+        'size': len(city.pop),
+        'seed': city.seed,
+        'initial_sick': int(np.count_nonzero(city.pop.initially_sick)),
+        'vectorized': city.vectorized,
+        'bulk': city.bulk,
+        'event_driven': city.event_driven,
+        'days': days,
+    }
+
+
+def save_city(path: pathlib.Path, city: City, days: int, summaries: t.Sequence[t.Dict] = ()):
+    """
+    Save a running city to a checkpoint file (a compressed .npz): the population's state columns, the current date,
+    the vaccine order and schedule and the state of the random number generators (see City.snapshot). The
+    demographics are not saved, they are rebuilt by making the city the same way again
+    :param path:
+    :param city:
+    :param days: the number of days the city is being run for
+    :param summaries: the daily summaries so far (see runner.simulate), to save with the city
+    :return:
+    """
+    snapshot = city.snapshot()
+    info = {
+        'name': city.name,
+        **run_info(city, days),
+        'current_date': snapshot.current_date.isoformat(),
+        'random_state': snapshot.random_state,
+        'rng_state': snapshot.rng_state,
+        'summaries': list(summaries),
+    }
+    dose_dates = sorted(city.vaccine_doses)
+    write_atomic(path, lambda file: np.savez_compressed(
+        file, info=np.array(json.dumps(info)), vaccine_order=snapshot.vaccine_order,
+        dose_dates=np.array([day.toordinal() for day in dose_dates], dtype=np.int64),
+        doses=np.array([city.vaccine_doses[day] for day in dose_dates], dtype=np.int64),
+        **snapshot.state))
+
+
+def load_city(path: pathlib.Path, city: City, days: int) -> t.List[t.Dict]:
+    """
+    Put a city back to where it was when it was saved with save_city. The city has to have been made the same way
+    as the one saved (same size, seed, initial sick, vectorized, bulk and event driven), not run yet, and be run for
+    the same number of days. If it wasn't, a ValueError is raised and the city isn't changed
+    :param path:
+    :param city:
+    :param days:
+    :return: the daily summaries saved with it
+    """
+    with np.load(path) as data:
+        info = json.loads(str(data['info']))
+        expected = run_info(city, days)
+        different = [name for name, value in expected.items() if info.get(name) != value]
+        if len(different) > 0:
+            raise ValueError(f"{path} was saved from a different run: "
+                             + ', '.join(f"{name} {info.get(name)} (not {expected[name]})" for name in different))
+        random_state = info['random_state']
+        if random_state is not None:
+            version, internal_state, gauss = random_state
+            random_state = (version, tuple(internal_state), gauss)
+        city.restore(CitySnapshot(
+            state={name: data[name] for name in city.pop.STATE_COLUMNS},
+            current_date=date.fromisoformat(info['current_date']),
+            vaccine_order=data['vaccine_order'],
+            random_state=random_state,
+            rng_state=info['rng_state'],
+        ))
+        city.set_vaccine_schedule({date.fromordinal(int(day)): int(doses)
+                                   for day, doses in zip(data['dose_dates'], data['doses'])})
+    return info['summaries']
@@ -1,24 +1,97 @@
-from person import Person
+from population import Population
+from contacts import ContactNetwork
+from locations import LocationIndex
+from stats import CityStats
+from active_cases import ActiveCases
+from progression import ProgressionSchedule
+from metrics import CityMetrics
+from partition import ShardPool
+from city_cache import CityCache
+import dataclasses
 import typing as t
 from datetime import date, timedelta
 from settings import *
+import numpy as np
 import random
+import copy
+import contextlib
+
+
+@dataclasses.dataclass
+class CitySnapshot:
+    """
+    Everything about a city that changes while the simulation runs (see City.snapshot)
+    """
+    state: t.Dict[str, np.ndarray]          # the population's state columns
+    current_date: date
+    vaccine_order: np.ndarray
+    random_state: t.Optional[tuple]         # None if the city uses the global random state
+    rng_state: dict
+
+
+_NOT_MEASURED = contextlib.nullcontext()
 
 
 class City:
-    def __init__(self, name: str, size: int = 1000, initial_sick: int = 100):
+    def __init__(self, name: str, size: int = 1000, initial_sick: int = 100, vectorized: bool = False,
+                 debug: bool = False, seed: t.Optional[int] = None, bulk: t.Optional[bool] = None,
+                 event_driven: bool = False, cache: t.Optional[CityCache] = None):
+        """
+        :param name: name of the city
+        :param size: number of people in the city
+        :param initial_sick: number of people who are sick at the start
+        :param vectorized: run the daily timestep on whole arrays: interactions are counted with sparse matrix
+            products and health is updated in one batch (much faster for large cities)
+        :param debug: check the running statistics and active cases against a full scan of the population every
+            time they are read
+        :param seed: seed for all of the city's random numbers (the people, infections and recoveries). If None, the
+            global `random` state is used, so random.seed() still repeats a run
+        :param bulk: generate the people and the initially sick with whole-array draws instead of one person at a
+            time (same distributions, different random draws). Defaults to the same as vectorized
+        :param event_driven: skip the work of a timestep on days when nothing can happen (see next_event_date).
+            The results are the same, the random numbers that would have been drawn on those days just aren't
+        :param cache: load the people and the helpers from this cache if a city was made the same way before (only for
+            seeded cities), or else add the city to it once it is built. The city is the same either way
+        """
         self.name = name
-        self.pop: t.List[Person] = []  # holds a list of people
-        self.households: t.Dict[int, t.Set[int]] = dict()  # gives the set of people in a household
-        self.work: t.Dict[int, t.Set[int]] = dict()  # gives the set of people at a workplace
-        self.shopping: t.Dict[int, t.Set[int]] = dict()  # gives the set of people at a shopping place
+        self.seed = seed
+        self.vectorized = vectorized
+        self.event_driven = event_driven
+        bulk = vectorized if bulk is None else bulk
+        self.bulk = bulk
+        self.random: random.Random = random.Random(seed) if seed is not None else random
+        # batched updates draw from a NumPy generator, seeded from the one above
+        self.rng: np.random.Generator = np.random.default_rng(
+            self.random.getrandbits(64) if vectorized or bulk or seed is not None else None)
         self.start_date: date = date(2021, 1, 1)
+        self.pop: Population = Population(start_date=self.start_date)  # holds everyone in the city
+        self.households: t.Optional[LocationIndex] = None  # gives the people in a household
+        self.work: t.Optional[LocationIndex] = None  # gives the people at a workplace
+        self.shopping: t.Optional[LocationIndex] = None  # gives the people at a shopping place
+        self.contacts: t.Optional[ContactNetwork] = None  # location memberships as sparse matrices
         self.current_date: date = self.start_date
         self.vaccine_dates: t.List[date] = [self.start_date + timedelta(days=15 * (i + 1)) for i in range(10)]
-        self.vaccine_order: t.List[int] = []  # a list showing the order people get their vaccines
-        self.add_people(pop_size=size)
-        self.create_sick_people(initial_sick)
-        self.build_helpers()
+        # the number of vaccines given on each of the vaccine dates (see set_vaccine_schedule)
+        self.vaccine_doses: t.Dict[date, int] = dict.fromkeys(self.vaccine_dates, size // len(self.vaccine_dates))
+        self.vaccine_order: np.ndarray = np.zeros(0, dtype=np.int64)  # the order people get their vaccines
+        self.vaccine_cursor: int = 0  # nobody before this position in vaccine_order can still get a vaccine
+        cache_key = CityCache.key(size, initial_sick, bulk, seed) if cache is not None and seed is not None else None
+        if cache_key is None or not cache.load(self, cache_key):
+            if bulk:
+                self.generate_people(pop_size=size)
+                self.generate_sick_people(initial_sick)
+            else:
+                self.add_people(pop_size=size)
+                self.create_sick_people(initial_sick)
+            self.build_helpers()
+            if cache_key is not None:
+                cache.save(self, cache_key)
+        self.debug = debug
+        self.stats = CityStats(self.pop, debug=debug)  # running totals, kept up to date as people change
+        self.active = ActiveCases(self.pop)  # the people who are contagious, kept up to date as people change
+        self.schedule = ProgressionSchedule(self.pop)  # the days people's disease moves on, added as they are infected
+        self.metrics: t.Optional[CityMetrics] = None  # set to measure each timestep (see measure)
+        self.shards: t.Optional[ShardPool] = None  # worker processes running the timestep, if partitioned
 
     @property
     def starting_population(self) -> int:
@@ -26,7 +99,7 @@ class City:
 
     @property
     def population(self) -> int:
-        return sum([p.is_alive for p in self.pop])
+        return self.stats.count('alive')
 
     @property
     def female_pct(self) -> float:
@@ -34,7 +107,7 @@ class City:
         Returns the % of the population that is female
         :return: [0, 1]
         """
-        return sum([p.sex_female for p in self.pop]) / self.starting_population
+        return self.stats.female / self.starting_population
 
     @property
     def num_dead(self) -> int:
@@ -42,7 +115,7 @@ class City:
         Finds the number of people who have died at the current date
         :return:
         """
-        return sum([not p.is_alive for p in self.pop])
+        return self.starting_population - self.population
 
     @property
     def num_sick(self) -> int:
@@ -50,7 +123,7 @@ class City:
         Finds the number of people who are sick at the current date
         :return:
         """
-        return sum([p.is_currently_sick for p in self.pop])
+        return self.stats.count('sick')
 
     @property
     def num_recovered(self) -> int:
@@ -58,7 +131,7 @@ class City:
         Finds the number of people who have recovered from covid at the current date
         :return:
         """
-        return sum([p.is_recovered for p in self.pop])
+        return self.stats.count('recovered')
 
     @property
     def num_uninfected(self) -> int:
@@ -66,7 +139,7 @@ class City:
         Finds the number of people who are uninfected from covid at the current date
         :return:
         """
-        return sum([p.is_vulnerable for p in self.pop])
+        return self.stats.count('uninfected')
 
     @property
     def num_vaccinated(self) -> int:
@@ -74,7 +147,7 @@ class City:
         Finds the number of people who have been vaccinated
         :return:
         """
-        return sum([p.is_vaccinated for p in self.pop])
+        return self.stats.count('vaccinated')
 
     @property
     def num_wasted_vaccines(self) -> int:
@@ -82,21 +155,19 @@ class City:
         Finds the number of people who were vaccinated but already sick
         :return:
         """
-        return sum([p.vaccine_wasted for p in self.pop])
+        return self.stats.count('wasted_vaccines')
 
     @property
     def teachers_pct_sick(self) -> float:
-        return sum([p.is_teacher and p.was_sick for p in self.pop]) / sum([p.is_teacher for p in self.pop])
+        return self.stats.count('teachers_sick') / self.stats.teachers
 
     @property
     def hospital_worker_pct_sick(self) -> float:
-        return sum([p.is_hospital_worker and p.was_sick for p in self.pop]) / sum(
-            [p.is_hospital_worker for p in self.pop])
+        return self.stats.count('hospital_workers_sick') / self.stats.hospital_workers
 
     @property
     def frontline_worker_pct_sick(self) -> float:
-        return sum([p.is_frontline_worker and p.was_sick for p in self.pop]) / sum(
-            [p.is_frontline_worker for p in self.pop])
+        return self.stats.count('frontline_workers_sick') / self.stats.frontline_workers
 
     # --------------------------------------------------------------------------------------------
     def run_timestep(self):
@@ -110,106 +181,227 @@ class City:
 
         :return:
         """
-        interactions = [0] * len(self.pop)
-        sick_people = self.get_sick_people()
-        self.step1_work(interactions, sick_people)
-        self.step2_home(interactions, sick_people)
-        self.step3_shopping(interactions, sick_people)
-        self.step4_vaccine()
-        self.step5_health_update(interactions)
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.start_day(self.current_date)
+        if self.event_driven and self.skip_idle_days(1) == 1:
+            if metrics is not None:
+                metrics.record(skipped=1)
+            return self.current_date
+        if self.vectorized:
+            # Steps 1-3 at once
+            with self.measure('step1-3_interactions'):
+                sick_people = self.get_sick_people()
+                if self.shards is not None:
+                    interactions = self.shards.interactions()
+                else:
+                    quarantined = self.active.quarantined.array()
+                    interactions = self.contacts.interactions(self.pop, sick_people, quarantined)
+        else:
+            interactions = np.zeros(len(self.pop), dtype=np.int64)
+            sick_people = self.get_sick_people().tolist()
+            with self.measure('step1_work'):
+                self.step1_work(interactions, sick_people)
+            with self.measure('step2_home'):
+                self.step2_home(interactions, sick_people)
+            with self.measure('step3_shopping'):
+                self.step3_shopping(interactions, sick_people)
+        with self.measure('step4_vaccine'):
+            self.step4_vaccine()
+        uninfected = self.num_uninfected if metrics is not None else 0
+        with self.measure('step5_health_update'):
+            self.step5_health_update(interactions)
+        if metrics is not None:
+            metrics.record(
+                sick_people=len(sick_people),
+                interactions=int(interactions.sum()),
+                infections=uninfected - self.num_uninfected,
+            )
         self.current_date += timedelta(days=1)
         return self.current_date
 
-    def get_sick_people(self) -> t.List[int]:
+    def measure(self, phase: str) -> t.ContextManager:
         """
-        Return the index of all the people who are contagious
+        Time a phase of the day, if the city is being measured: `with city.measure('step4_vaccine'): ...`
+        :param phase: the name of the phase
         :return:
         """
-        return [idx for idx, p in enumerate(self.pop) if p.is_infected]
+        if self.metrics is None:
+            return _NOT_MEASURED
+        return self.metrics.phase(phase)
 
-    def step1_work(self, interactions: t.List[int], sick_people: t.List[int]):
+    def run_days(self, days: int):
+        """
+        Run a number of timesteps. When event driven, the days when nothing can happen are jumped over at once
+        :param days:
+        :return:
+        """
+        while days > 0:
+            if self.event_driven:
+                days -= self.skip_idle_days(days)
+                if days == 0:
+                    break
+            self.run_timestep()
+            days -= 1
+
+    def next_event_date(self) -> t.Optional[date]:
+        """
+        The first day (from today) whose timestep can change anything. While anyone is contagious that is every
+        day. Once nobody is, nobody can catch covid again, so only the vaccine dates are left
+        :return: None if nothing can change any more
+        """
+        if len(self.active) > 0:
+            return self.current_date
+        return min((day for day, doses in self.vaccine_doses.items() if day >= self.current_date and doses > 0),
+                   default=None)
+
+    def skip_idle_days(self, max_days: int) -> int:
+        """
+        Jump over the days from today on when nothing can happen (see next_event_date)
+        :param max_days: the most days to skip
+        :return: the number of days skipped
+        """
+        next_event = self.next_event_date()
+        days = max_days if next_event is None else min(max_days, (next_event - self.current_date).days)
+        self.current_date += timedelta(days=days)
+        return days
+
+    @property
+    def current_day(self) -> int:
+        """
+        The current date as a day offset from the start date
+        :return:
+        """
+        return (self.current_date - self.start_date).days
+
+    def get_sick_people(self) -> np.ndarray:
+        """
+        Return the index of all the people who are contagious (in no particular order)
+        :return:
+        """
+        if self.debug:
+            self.active.check()
+        return self.active.all()
+
+    def step1_work(self, interactions: np.ndarray, sick_people: t.List[int]):
         """
         Update all the interactions a sick person has with everyone else
-        :param interactions: a list (size: pop) of all the interactions with sick people from the city
+        :param interactions: an array (size: pop) of all the interactions with sick people from the city
         :param sick_people: a list of all the sick people
         :return:
         """
+        in_quarantine = self.pop.in_quarantine
+        work = self.pop.work
+        vulnerable = self.pop.is_vulnerable
         for sick_idx in sick_people:
-            sick_person = self.pop[sick_idx]
-            if not sick_person.in_quarantine:
+            if not in_quarantine[sick_idx]:
                 continue  # Can't get people sick at work if you are in quarantine
-            for other_idx in self.work.get(sick_person.work, set()):
-                work_person = self.pop[other_idx]
-                if work_person.is_vulnerable:
-                    interactions[other_idx] += 10
+            work_people = self.work[work[sick_idx]]
+            interactions[work_people[vulnerable[work_people]]] += WORK_INTERACTIONS
 
-    def step2_home(self, interactions: t.List[int], sick_people: t.List[int]):
+    def step2_home(self, interactions: np.ndarray, sick_people: t.List[int]):
         """
         Update all the interactions at home
-        :param interactions: a list (size: pop) of all the interactions with sick people from the city
+        :param interactions: an array (size: pop) of all the interactions with sick people from the city
         :param sick_people: a list of all the sick people
         :return:
         """
+        household = self.pop.household
+        vulnerable = self.pop.is_vulnerable
         for sick_idx in sick_people:
-            sick_person = self.pop[sick_idx]
-            for other_idx in self.households[sick_person.household]:
-                home_person = self.pop[other_idx]
-                if home_person.is_vulnerable:
-                    interactions[other_idx] += 40
+            home_people = self.households[household[sick_idx]]
+            interactions[home_people[vulnerable[home_people]]] += HOME_INTERACTIONS
 
-    def step3_shopping(self, interactions: t.List[int], sick_people: t.List[int]):
+    def step3_shopping(self, interactions: np.ndarray, sick_people: t.List[int]):
         """
         Update all the interactions from shopping
-        :param interactions: a list (size: pop) of all the interactions with sick people from the city
+        :param interactions: an array (size: pop) of all the interactions with sick people from the city
         :param sick_people: a list of all the sick people
         :return:
         """
+        workplace_id = self.pop.workplace_id
+        vulnerable = self.pop.is_vulnerable
         for sick_idx in sick_people:
-            sick_person = self.pop[sick_idx]
-            sick_person_places = sick_person.shopping | {sick_person.workplace_id}
+            sick_person_places = self.pop.shops_of(sick_idx) | {workplace_id[sick_idx]}
             for sick_place in sick_person_places:
-                for other_idx in self.shopping.get(sick_place, set()):
-                    shop_person = self.pop[other_idx]
-                    if shop_person.is_vulnerable:
-                        interactions[other_idx] += 5
+                shop_people = self.shopping[sick_place]
+                interactions[shop_people[vulnerable[shop_people]]] += SHOPPING_INTERACTIONS
 
     def step4_vaccine(self):
         """
         Apply the vaccine, based on the score
         :return:
         """
-        if self.current_date not in self.vaccine_dates:
+        vaccines_available = self.vaccine_doses.get(self.current_date, 0)
+        if vaccines_available <= 0:
             return
         if len(self.vaccine_order) == 0:
             # make sure we've set up the vaccine order first
             self.set_vaccine_order()
-        vaccines_available = len(self.pop) // len(self.vaccine_dates)
-        vaccines_given = 0
-        for idx in self.vaccine_order:
-            person = self.pop[idx]
-            if person.is_alive and person.is_vaccinated is False and person.vaccine_score >= 0:
-                person.vaccinate()
-                vaccines_given += 1
-            if vaccines_given >= vaccines_available:
-                break
-
-    def step5_health_update(self, interactions: t.List[int]):
+
+        # The people passed over (dead, vaccinated or with no score) never become eligible again, so each vaccine
+        # date carries on from where the last one stopped. The order is checked a window at a time
+        is_alive = self.pop.is_alive
+        is_vaccinated = self.pop.is_vaccinated
+        vaccine_score = self.pop.vaccine_score
+        chosen = []
+        while vaccines_available > 0 and self.vaccine_cursor < len(self.vaccine_order):
+            window = self.vaccine_order[self.vaccine_cursor:self.vaccine_cursor + max(2 * vaccines_available, 1024)]
+            eligible = is_alive[window] & ~is_vaccinated[window] & (vaccine_score[window] >= 0)
+            given = np.flatnonzero(eligible)[:vaccines_available]
+            chosen.append(window[given])
+            vaccines_available -= len(given)
+            self.vaccine_cursor += int(given[-1]) + 1 if vaccines_available == 0 else len(window)
+        if len(chosen) > 0:
+            self.pop.vaccinate(np.concatenate(chosen))
+
+    def step5_health_update(self, interactions: np.ndarray):
         """
         Update everyone's health
 
         TODO: Modify the chance of sickness by demographic details like age, income level, work from home etc.
 
-        :param interactions: a list (size: pop) of all the interactions with sick people from the city
+        :param interactions: an array (size: pop) of all the interactions with sick people from the city
+        :return:
+        """
+        if self.vectorized:
+            self.step5_health_update_batched(interactions)
+            return
+
+        # Only the vulnerable can be infected and only the sick who reach a stage today have their health change.
+        # Both draw random numbers, so they are gone through together in index order
+        vulnerable = np.flatnonzero(self.pop.is_vulnerable)
+        due = self.schedule.pop_due(self.current_day)
+        people = np.concatenate([vulnerable, due])
+        order = np.argsort(people, kind='stable')
+        is_due = (order >= len(vulnerable)).tolist()
+        people = people[order].tolist()
+        probability = self.pop.chance_of_getting_covid(interactions).tolist()
+        for idx, update_health in zip(people, is_due):
+            if not update_health:
+                if self.random.random() < probability[idx]:
+                    self.pop.infect(idx, self.current_day)
+            else:
+                # update their health
+                self.pop[idx].update_health(self.current_date, self.random)
+
+    def step5_health_update_batched(self, interactions: np.ndarray):
+        """
+        Update everyone's health in one batch. Same rules as step5_health_update, but the infection chances,
+        stage changes and recovery draws are done over whole arrays (the infections by the shards, if partitioned)
+        :param interactions: an array (size: pop) of all the interactions with sick people from the city
         :return:
         """
-        for idx, person in enumerate(self.pop):
-            if person.is_vulnerable:
-                num_interactions = interactions[idx]
-                if random.random() < person.chance_of_getting_covid(num_interactions):
-                    person.infect(self.current_date)
+        if self.shards is not None:
+            infected = self.shards.infections(self.rng)
+        else:
+            vulnerable = np.flatnonzero(self.pop.is_vulnerable)
+            probability = self.pop.chance_of_getting_covid(interactions)[vulnerable]
+            infected = vulnerable[self.rng.random(len(vulnerable)) < probability]
 
-            # update their health
-            person.update_health(self.current_date)
+        # update their health (the newly infected have nothing happen on their first day)
+        self.pop.update_health(self.current_day, self.rng, self.schedule.pop_due(self.current_day))
+        self.pop.infect(infected, self.current_day)
 
     # City Setup -------------------------------------------------------------------------------------------------------
     def add_people(self, pop_size: int):
@@ -218,12 +410,21 @@ class City:
         :param pop_size:
         :return:
         """
+        people: t.Dict[str, list] = {
+            'age': [], 'work': [], 'shopping': [], 'preexisting_condition': [], 'household': [], 'sex_female': []
+        }
+
+        def add_person(**person):
+            if len(people['age']) < pop_size:
+                for column, value in person.items():
+                    people[column].append(value)
+
         current_household = 0
-        while len(self.pop) < pop_size:
+        while len(people['age']) < pop_size:
             # make the first adult in the household
-            for _ in range(random.randint(1, 4)):
-                age = random.randint(18, 65)
-                random_value = random.random()
+            for _ in range(self.random.randint(1, 4)):
+                age = self.random.randint(18, 65)
+                random_value = self.random.random()
                 if random_value < 0.04:
                     work = HOSPITAL_ID
                 elif random_value < 0.08:
@@ -231,32 +432,27 @@ class City:
                 elif random_value < (0.08 + 0.10):
                     work = FRONTLINE_ID
                 else:
-                    work = random.randint(FRONTLINE_ID+1, 20)
-                adult = Person(
+                    work = self.random.randint(FRONTLINE_ID+1, MAX_WORK_ID)
+                add_person(
                     age=age,
                     work=work,
-                    shopping=set([random.randint(0, 20) for _ in range(6)]),
-                    preexisting_condition=(random.random() < 0.05) if age < 50 else (random.random() < 0.10),
+                    shopping=set([self.random.randint(0, MAX_SHOP_ID) for _ in range(6)]),
+                    preexisting_condition=(self.random.random() < 0.05) if age < 50 else (self.random.random() < 0.10),
                     household=current_household,
-                    sex_female=True if random.random() >= 0.5 else False,
-                    is_alive=True
+                    sex_female=True if self.random.random() >= 0.5 else False,
                 )
-                if len(self.pop) < pop_size:
-                    self.pop.append(adult)
-            for _ in range(random.randint(0, 3)):
-                age = random.randint(0, 18)
-                kid = Person(
+            for _ in range(self.random.randint(0, 3)):
+                age = self.random.randint(0, 18)
+                add_person(
                     age=age,
                     work=SCHOOL_ID if age > 5 else NO_WORK_ID,
-                    shopping=set([random.randint(0, 20) for _ in range(2)]),
-                    preexisting_condition=(random.random() < 0.05),
+                    shopping=set([self.random.randint(0, MAX_SHOP_ID) for _ in range(2)]),
+                    preexisting_condition=(self.random.random() < 0.05),
                     household=current_household,
-                    sex_female=True if random.random() >= 0.5 else False,
-                    is_alive=True
+                    sex_female=True if self.random.random() >= 0.5 else False,
                 )
-                if len(self.pop) < pop_size:
-                    self.pop.append(kid)
             current_household += 1
+        self.pop = Population.from_columns(start_date=self.start_date, **people)
 
     def create_sick_people(self, number_sick: int):
         """
@@ -265,43 +461,141 @@ class City:
         :param number_sick:
         :return:
         """
-        for sick_idx in random.sample(range(len(self.pop)), number_sick):
+        for sick_idx in self.random.sample(range(len(self.pop)), number_sick):
             person = self.pop[sick_idx]
-            days_since_infection = random.randint(0, 14)
+            days_since_infection = self.random.randint(0, 14)
             sick_day = self.start_date - timedelta(days=days_since_infection)
             person.infect(sick_day)
             person.initially_sick = True
             for j in range(days_since_infection):
-                person.update_health(sick_day + timedelta(days=j))
+                person.update_health(sick_day + timedelta(days=j), self.random)
 
-    def build_helpers(self):
+    def generate_people(self, pop_size: int):
         """
-        Make helpers to easily find people in a household, shopping or workplace
+        Create the people in the city all at once (see Population.generate)
+        :param pop_size:
         :return:
         """
-        self.households = {
-            household_num: set([idx for idx in range(len(self.pop)) if self.pop[idx].household == household_num])
-            for household_num in set([p.household for p in self.pop])
-        }
-        self.work = {
-            work_num: set([idx for idx in range(len(self.pop)) if self.pop[idx].work == work_num])
-            for work_num in set([p.work for p in self.pop])
-        }
+        self.pop = Population.generate(pop_size, self.rng, start_date=self.start_date)
 
-        # shopping is a bit more complicated because they are sets
-        all_shopping = [p.shopping for p in self.pop]
-        shopping_indexes = set()
-        for shop in all_shopping:
-            shopping_indexes = shopping_indexes | shop
+    def generate_sick_people(self, number_sick: int):
+        """
+        Create a bunch of random sick people all at once. Like create_sick_people, they were infected up to 14 days
+        ago and have already been through those days of the disease
+        :param number_sick:
+        :return:
+        """
+        sick = self.rng.choice(len(self.pop), size=number_sick, replace=False)
+        days_since_infection = self.rng.integers(0, 15, number_sick)
+        self.pop.infect(sick, -days_since_infection)
+        self.pop.initially_sick[sick] = True
+        self.pop.fast_forward(sick, self.rng)
 
-        self.shopping = {
-            shop_num: set([idx for idx in range(len(self.pop)) if shop_num in self.pop[idx].shopping])
-            for shop_num in shopping_indexes
-        }
+    def build_helpers(self):
+        """
+        Make helpers to easily find people in a household, shopping or workplace. Each is built in linear time
+        :return:
+        """
+        self.households = LocationIndex.from_location(self.pop.household)
+        self.work = LocationIndex.from_location(
+            self.pop.work, first_id=NO_WORK_ID, num_locations=MAX_WORK_ID - NO_WORK_ID + 1)
+        self.shopping = LocationIndex.from_membership(self.pop.shopping_matrix())
+        self.contacts = ContactNetwork(self.households, self.work, self.shopping, len(self.pop))
 
     def set_vaccine_order(self):
         """
         Sets up the order that people get their vaccines. Ordered by the vaccine_score
         :return:
         """
-        self.vaccine_order = sorted(range(len(self.pop)), key=lambda x: self.pop[x].vaccine_score)
+        self.vaccine_order = np.argsort(self.pop.vaccine_score, kind='stable')
+        self.vaccine_cursor = 0
+
+    def set_vaccine_schedule(self, doses: t.Mapping[date, int]):
+        """
+        Set how many vaccines are given on which dates (instead of the same number every 15 days)
+        :param doses: the number of vaccines given on each vaccine date
+        :return:
+        """
+        self.vaccine_dates = sorted(doses)
+        self.vaccine_doses = dict(doses)
+
+    def partition(self, shards: int) -> ShardPool:
+        """
+        Run the timesteps on several worker processes, each holding a range of households (see ShardPool). The
+        results are the same as running in this process. Only for vectorized cities. Close the pool (or use it in a
+        with block) to stop the workers:
+
+            with city.partition(4):
+                city.run_days(365)
+
+        :param shards: the number of worker processes
+        :return:
+        """
+        if not self.vectorized:
+            raise ValueError('Only vectorized cities can be partitioned')
+        if self.shards is not None:
+            self.shards.close()
+        self.shards = ShardPool(self, shards)
+        return self.shards
+
+    # Copies -----------------------------------------------------------------------------------------------------------
+    def snapshot(self) -> CitySnapshot:
+        """
+        Save the state of the simulation, to go back to later with restore()
+        :return:
+        """
+        return CitySnapshot(
+            state=self.pop.get_state(),
+            current_date=self.current_date,
+            vaccine_order=self.vaccine_order.copy(),
+            random_state=self.random.getstate() if isinstance(self.random, random.Random) else None,
+            rng_state=copy.deepcopy(self.rng.bit_generator.state),
+        )
+
+    def restore(self, snapshot: CitySnapshot):
+        """
+        Go back to a saved state of the simulation (from snapshot() on this city or a clone of it)
+        :param snapshot:
+        :return:
+        """
+        self.pop.set_state(snapshot.state)
+        if self.shards is not None:
+            self.shards.share()
+        self.stats.reset()
+        self.active.reset()
+        self.current_date = snapshot.current_date
+        self.schedule.reset(self.current_day)
+        self.vaccine_order = snapshot.vaccine_order.copy()
+        self.vaccine_cursor = 0
+        if snapshot.random_state is not None:
+            self.random.setstate(snapshot.random_state)
+        self.rng.bit_generator.state = copy.deepcopy(snapshot.rng_state)
+
+    def clone(self) -> 'City':
+        """
+        A cheap copy of the city. The people's demographics and the household/work/shopping helpers are shared
+        with the copy (they don't change during a simulation), only the state is copied.
+
+        Use this instead of copy.deepcopy to run several strategies on the same city. The copy isn't measured
+        (see metrics)
+        :return:
+        """
+        city = copy.copy(self)
+        city.pop = self.pop.clone()
+        city.stats = self.stats.clone(city.pop)
+        city.active = self.active.clone(city.pop)
+        city.schedule = self.schedule.clone(city.pop)
+        city.metrics = None
+        if self.shards is not None:
+            # the shared columns go away when the shards are closed, so the copy gets its own
+            city.shards = None
+            for name in Population.DEMOGRAPHIC_COLUMNS:
+                setattr(city.pop, name, getattr(city.pop, name).copy())
+        city.vaccine_dates = list(self.vaccine_dates)
+        city.vaccine_doses = dict(self.vaccine_doses)
+        city.vaccine_order = self.vaccine_order.copy()
+        if isinstance(self.random, random.Random):
+            city.random = random.Random()
+            city.random.setstate(self.random.getstate())
+        city.rng = copy.deepcopy(self.rng)
+        return city
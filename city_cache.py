@@ -0,0 +1,164 @@
+from population import Population
+from locations import LocationIndex
+from contacts import ContactNetwork
+from scipy import sparse
+import typing as t
+import pathlib
+import shutil
+import random
+import json
+import os
+import numpy as np
+
+if t.TYPE_CHECKING:
+    from city import City
+
+
+CACHE_VERSION = 1       # change when the way cities are generated changes, so older cities aren't used
+LOCATIONS = ('households', 'work', 'shopping')
+MATRICES = ('households_t', 'work_t', 'shopping_t', 'households', 'work', 'shopping')
+
+
+class CityCache:
+    """
+    Cities that have already been generated, kept on disk so a city made the same way again (same size, initially
+    sick, bulk and seed, see City) is loaded instead of generated. Each city is a directory of .npy files: the
+    population's columns, the location indexes and the contact matrices, plus the state of the random number
+    generators once the city was built. The files are memory mapped when a city is loaded, so only the parts that
+    are used are read, when they are used (the state columns are copy-on-write, so the files never change).
+
+    Once the cities take up more than max_bytes, the ones used longest ago are deleted
+    """
+    def __init__(self, path: pathlib.Path, max_bytes: int = 10 * 2 ** 30):
+        """
+        :param path: the directory to keep the cities in (made if needed, and reused if it exists)
+        :param max_bytes: the most disk space to use
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        path.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(size: int, initial_sick: int, bulk: bool, seed: int) -> str:
+        """
+        Names a city by what it was built from (see City.__init__)
+        :return:
+        """
+        return f"v{CACHE_VERSION}-{size}-{initial_sick}-{'bulk' if bulk else 'loop'}-{seed}"
+
+    def directory(self, key: str) -> pathlib.Path:
+        return self.path / key
+
+    def __contains__(self, key: str) -> bool:
+        return (self.directory(key) / 'info.json').exists()
+
+    def load(self, city: 'City', key: str) -> bool:
+        """
+        Give a city the people, helpers and random states of a cached city
+        :param city: a city being made (see City.__init__)
+        :param key:
+        :return: False if the city isn't in the cache
+        """
+        directory = self.directory(key)
+        try:
+            info = json.loads((directory / 'info.json').read_text())
+            os.utime(directory / 'info.json')   # used now, for the LRU order
+        except FileNotFoundError:
+            return False
+
+        def array(name: str, mode: str = 'r') -> np.ndarray:
+            return np.load(directory / f'{name}.npy', mmap_mode=mode)
+
+        pop = Population.__new__(Population)
+        pop.start_date = city.start_date
+        pop.observers = []
+        for name in Population.DEMOGRAPHIC_COLUMNS:
+            setattr(pop, name, array(name))
+        for name in Population.STATE_COLUMNS:
+            setattr(pop, name, array(name, 'c'))
+        city.pop = pop
+
+        for name in LOCATIONS:
+            index = LocationIndex.__new__(LocationIndex)
+            index.first_id = info['first_ids'][name]
+            index.offsets = array(f'{name}.offsets')
+            index.members = array(f'{name}.members')
+            setattr(city, name, index)
+        contacts = ContactNetwork.__new__(ContactNetwork)
+        for name in MATRICES:
+            setattr(contacts, name, sparse.csr_matrix(
+                (array(f'contacts.{name}.data'), array(f'contacts.{name}.indices'), array(f'contacts.{name}.indptr')),
+                shape=tuple(info['shapes'][name]), copy=False
+            ))
+        city.contacts = contacts
+
+        if info['random_state'] is not None:
+            version, internal_state, gauss = info['random_state']
+            city.random.setstate((version, tuple(internal_state), gauss))
+        city.rng.bit_generator.state = info['rng_state']
+        return True
+
+    def save(self, city: 'City', key: str):
+        """
+        Add a city that has just been built (before it is run), then make room if needed
+        :param city:
+        :param key:
+        :return:
+        """
+        if key in self:
+            return
+        # write to a directory of its own then rename it, so a reader never sees half a city (and if another
+        # process saved the same city first, that one is kept)
+        temp_directory = self.path / f'{key}.tmp{os.getpid()}'
+        temp_directory.mkdir()
+        arrays = {name: getattr(city.pop, name)
+                  for name in Population.DEMOGRAPHIC_COLUMNS + Population.STATE_COLUMNS}
+        for name in LOCATIONS:
+            index: LocationIndex = getattr(city, name)
+            arrays[f'{name}.offsets'] = index.offsets
+            arrays[f'{name}.members'] = index.members
+        for name in MATRICES:
+            matrix: sparse.csr_matrix = getattr(city.contacts, name)
+            arrays[f'contacts.{name}.data'] = matrix.data
+            arrays[f'contacts.{name}.indices'] = matrix.indices
+            arrays[f'contacts.{name}.indptr'] = matrix.indptr
+        for name, values in arrays.items():
+            np.save(temp_directory / f'{name}.npy', values)
+        info = {
+            'first_ids': {name: getattr(city, name).first_id for name in LOCATIONS},
+            'shapes': {name: getattr(city.contacts, name).shape for name in MATRICES},
+            'random_state': city.random.getstate() if isinstance(city.random, random.Random) else None,
+            'rng_state': city.rng.bit_generator.state,
+        }
+        (temp_directory / 'info.json').write_text(json.dumps(info))
+        try:
+            os.rename(temp_directory, self.directory(key))
+        except OSError:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+        self.evict(keep=key)
+
+    def size(self, key: str) -> int:
+        """
+        The disk space a city takes
+        :param key:
+        :return: bytes
+        """
+        return sum(file.stat().st_size for file in self.directory(key).iterdir())
+
+    def evict(self, keep: t.Optional[str] = None):
+        """
+        Delete the cities used longest ago until they all fit in max_bytes
+        :param keep: a city not to delete (eg. the one just added)
+        :return:
+        """
+        keys = [directory.name for directory in self.path.iterdir() if (directory / 'info.json').exists()]
+        last_used = {key: (self.directory(key) / 'info.json').stat().st_mtime for key in keys}
+        sizes = {key: self.size(key) for key in keys}
+        total = sum(sizes.values())
+        for key in sorted(keys, key=last_used.get):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                # cities already loaded keep working, their memory maps hold on to the files
+                shutil.rmtree(self.directory(key), ignore_errors=True)
+                total -= sizes[key]
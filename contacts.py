@@ -0,0 +1,75 @@
+from population import Population
+from locations import LocationIndex
+from scipy import sparse
+import numpy as np
+
+from settings import *
+
+
+def incidence_matrix(index: LocationIndex, num_people: int) -> sparse.csr_matrix:
+    """
+    Build a (locations, people) sparse matrix with a 1 where a person belongs to a location. This is the
+    location index's CSR layout as it is
+    :param index: who belongs to each location
+    :param num_people: the number of people
+    :return:
+    """
+    return sparse.csr_matrix(
+        (np.ones(len(index.members), dtype=np.int64), index.members, index.offsets),
+        shape=(len(index), num_people)
+    )
+
+
+class ContactNetwork:
+    """
+    Holds who belongs to each household, workplace and shopping place as sparse incidence matrices
+    (people x locations), so a whole day of interactions can be counted with a few sparse
+    matrix-vector products instead of looping over every sick person and everyone they meet
+    """
+    def __init__(self, households: LocationIndex, work: LocationIndex, shopping: LocationIndex, num_people: int):
+        # (locations, people) matrices, used to count the sick at each location
+        self.households_t = incidence_matrix(households, num_people)
+        self.work_t = incidence_matrix(work, num_people)
+        self.shopping_t = incidence_matrix(shopping, num_people)
+
+        # (people, locations) matrices, used to give each person the count at their locations
+        self.households = self.households_t.T.tocsr()
+        self.work = self.work_t.T.tocsr()
+        self.shopping = self.shopping_t.T.tocsr()
+
+    def interactions(self, pop: Population, sick: np.ndarray, quarantined: np.ndarray) -> np.ndarray:
+        """
+        Count the interactions everyone has with sick people today. Matches City.step1_work,
+        City.step2_home and City.step3_shopping
+        :param pop: the population of the city
+        :param sick: index of all the people who are contagious
+        :param quarantined: index of the contagious people who are in quarantine
+        :return: an array (size: pop) of all the interactions with sick people from the city
+        """
+        def indicator(idx: np.ndarray) -> np.ndarray:
+            vector = np.zeros(len(pop), dtype=np.int64)
+            vector[idx] = 1
+            return vector
+
+        sick_vector = indicator(sick)
+
+        # Step 1: sick people in quarantine meet everyone at their (usual) workplace
+        work_sick = self.work_t @ indicator(quarantined)
+        interactions = WORK_INTERACTIONS * (self.work @ work_sick)
+
+        # Step 2: sick people meet everyone in their household
+        households_sick = self.households_t @ sick_vector
+        interactions += HOME_INTERACTIONS * (self.households @ households_sick)
+
+        # Step 3: sick people visit their shops and the shop matching their workplace id (once if it is both)
+        shopping_sick = self.shopping_t @ sick_vector
+        workplace = np.where(pop.sickness_level[sick] == 3, HOSPITAL_ID, pop.work[sick])
+        is_shop = (workplace >= 0) & (workplace <= MAX_SHOP_ID)
+        sick, workplace = sick[is_shop], workplace[is_shop]
+        visits_workplace = (pop.shopping[sick] >> workplace.astype(np.uint32)) & 1 == 0
+        shopping_sick += np.bincount(workplace[visits_workplace], minlength=MAX_SHOP_ID + 1)
+        interactions += SHOPPING_INTERACTIONS * (self.shopping @ shopping_sick)
+
+        # Only vulnerable people pick up interactions
+        interactions[~pop.is_vulnerable] = 0
+        return interactions
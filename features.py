@@ -0,0 +1,124 @@
+from city import City
+import typing as t
+import copy
+import numpy as np
+
+from settings import *
+
+
+# Features -------------------------------------------------------------------------------------------------------------
+# Each feature takes a city and returns one value per person, computed for the whole population at once
+FeatureFn = t.Callable[[City], np.ndarray]
+
+
+def _household_size(city: City) -> np.ndarray:
+    return city.households.sizes_of(city.pop.household)
+
+
+def _workplace_size(city: City) -> np.ndarray:
+    size = city.work.sizes_of(city.pop.work)
+    size[city.pop.work == NO_WORK_ID] = 0
+    return size
+
+
+FEATURES: t.Dict[str, FeatureFn] = {
+    'age': lambda city: city.pop.age,
+    'is_teacher': lambda city: city.pop.is_teacher,
+    'is_frontline_worker': lambda city: city.pop.is_frontline_worker,
+    'is_hospital_worker': lambda city: city.pop.is_hospital_worker,
+    'preexisting_condition': lambda city: city.pop.preexisting_condition,
+    'shop_count': lambda city: city.pop.shopping_matrix().sum(axis=1),
+    'female': lambda city: city.pop.sex_female,
+    'household_size': _household_size,
+    'workplace_size': _workplace_size,
+}
+
+# The features VaccineAI was first trained on
+DEFAULT_FEATURES: t.Tuple[str, ...] = (
+    'age',
+    'is_teacher',
+    'is_frontline_worker',
+    'is_hospital_worker',
+    'preexisting_condition',
+    'shop_count',
+)
+
+
+def check_features(features: t.Sequence[str]):
+    """
+    Make sure every feature name is known
+    :param features: names from FEATURES
+    :return:
+    """
+    unknown = [name for name in features if name not in FEATURES]
+    if len(unknown) > 0:
+        raise ValueError(f'Unknown features {unknown}, expected some of {list(FEATURES)}')
+
+
+def _rows(city: City, people: slice) -> City:
+    """
+    The city as the features see it when only some of the people are wanted: a shallow copy whose population is
+    just those people (see Population.rows). The locations are the whole city's
+    :param city:
+    :param people:
+    :return:
+    """
+    if people == slice(None):
+        return city
+    rows = copy.copy(city)
+    rows.pop = city.pop.rows(people)
+    return rows
+
+
+def feature_columns(city: City, features: t.Sequence[str] = tuple(FEATURES),
+                    people: slice = slice(None)) -> t.Dict[str, np.ndarray]:
+    """
+    Compute features for everyone in the city, keeping each one's own dtype
+    :param city:
+    :param features: names from FEATURES (default: all of them)
+    :param people: a range of people to compute them for (default: everyone)
+    :return: an array (size: pop, or the number of people in the range) for each feature
+    """
+    check_features(features)
+    city = _rows(city, people)
+    return {name: np.asarray(FEATURES[name](city)) for name in features}
+
+
+def stack_features(columns: t.Mapping[str, np.ndarray], features: t.Sequence[str]) -> np.ndarray:
+    """
+    Put some feature columns side by side as the inputs of the network
+    :param columns: an array (size: pop) for each feature, see feature_columns
+    :param features: the names of the columns to use, in order
+    :return: a float32 array (size: pop, len(features))
+    """
+    x = np.empty((len(columns[features[0]]) if len(features) > 0 else 0, len(features)), dtype=np.float32)
+    for column, name in enumerate(features):
+        x[:, column] = columns[name]
+    return x
+
+
+def feature_matrix(city: City, features: t.Sequence[str] = DEFAULT_FEATURES,
+                   people: slice = slice(None)) -> np.ndarray:
+    """
+    Build the inputs of the network for everyone in the city
+    :param city:
+    :param features: names from FEATURES, one column each
+    :param people: a range of people to build them for (default: everyone)
+    :return: a float32 array (size: pop, or the number of people in the range, len(features))
+    """
+    return stack_features(feature_columns(city, features, people), features)
+
+
+def outcome_labels(city: City) -> np.ndarray:
+    """
+    How everyone in the city did by the end of a simulation (see COVIDloss):
+    0 = ignore (initially sick), 2 = died, 1 = got sick, -1 = didn't get sick
+    :param city:
+    :return: a float32 array (size: pop)
+    """
+    pop = city.pop
+    return np.select(
+        [pop.initially_sick, ~pop.is_alive, pop.was_sick],
+        [0, 2, 1],
+        default=-1
+    ).astype(np.float32)
@@ -0,0 +1,91 @@
+import typing as t
+import numpy as np
+
+
+class LocationIndex:
+    """
+    Who belongs to each location (household, workplace or shopping place) in a compact CSR layout: the
+    members of location id are members[offsets[id - first_id]:offsets[id - first_id + 1]], in index order.
+
+    Built with a single counting sort over the (person, location) pairs, so it takes linear time however
+    many locations there are.
+    """
+    def __init__(self, people: np.ndarray, locations: np.ndarray, first_id: int, num_locations: int):
+        """
+        :param people: index of the person for each (person, location) pair
+        :param locations: location id for each (person, location) pair
+        :param first_id: the smallest location id
+        :param num_locations: the number of location ids (first_id, first_id + 1, ...)
+        """
+        self.first_id = first_id
+        slots = np.asarray(locations, dtype=np.int64) - first_id
+        counts = np.bincount(slots, minlength=num_locations)
+        self.offsets: np.ndarray = np.zeros(num_locations + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.members: np.ndarray = np.asarray(people, dtype=np.int64)[np.argsort(slots, kind='stable')]
+
+    @classmethod
+    def from_location(cls, location: np.ndarray, first_id: int = 0,
+                      num_locations: t.Optional[int] = None) -> 'LocationIndex':
+        """
+        Index people who each belong to exactly one location
+        :param location: an array (size: pop) of the location id of each person
+        :param first_id: the smallest location id
+        :param num_locations: the number of location ids (default: up to the largest one used)
+        :return:
+        """
+        if num_locations is None:
+            num_locations = int(location.max()) - first_id + 1 if len(location) > 0 else 0
+        return cls(np.arange(len(location)), location, first_id, num_locations)
+
+    @classmethod
+    def from_membership(cls, membership: np.ndarray, first_id: int = 0) -> 'LocationIndex':
+        """
+        Index people who can belong to several locations
+        :param membership: a (pop, locations) boolean array, True where a person belongs to a location
+        :param first_id: the location id of the first column
+        :return:
+        """
+        people, locations = np.nonzero(membership)
+        return cls(people, locations + first_id, first_id, membership.shape[1])
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, location_id: int) -> np.ndarray:
+        """
+        The people at a location (none if the location id is not known)
+        :param location_id:
+        :return: an array of person indexes
+        """
+        slot = location_id - self.first_id
+        if not 0 <= slot < len(self):
+            return self.members[:0]
+        return self.members[self.offsets[slot]:self.offsets[slot + 1]]
+
+    def __contains__(self, location_id: int) -> bool:
+        return len(self[location_id]) > 0
+
+    def keys(self) -> t.List[int]:
+        """
+        The ids of every location with someone in it
+        :return:
+        """
+        return (np.flatnonzero(self.sizes) + self.first_id).tolist()
+
+    @property
+    def sizes(self) -> np.ndarray:
+        """
+        The number of people at each location id (starting at first_id)
+        :return:
+        """
+        return np.diff(self.offsets)
+
+    def sizes_of(self, location_ids: np.ndarray) -> np.ndarray:
+        """
+        The number of people at some locations, without working out the size of every location
+        :param location_ids: an array of location ids (all in [first_id, first_id + len(self)))
+        :return: an array of sizes, one for each id
+        """
+        slots = np.asarray(location_ids, dtype=np.int64) - self.first_id
+        return self.offsets[slots + 1] - self.offsets[slots]
@@ -1,92 +1,49 @@
 from city import City
-from person import Person
 from vaccine import VaccineBase, NoVaccine, RandomVaccine
 from ai_vaccine import VaccineAI
+from report import write_csv
+from runner import CityConfig, run_trials, simulate
+from city_cache import CityCache
+from sinks import make_sink
+from metrics import CityMetrics
 from settings import *
-import copy
 import time
-import csv
 
 
-def create_person_dictionary(p: Person):
-    return {
-        'vaccine_score': p.vaccine_score,
-        'is_heathcare': p.is_hospital_worker,
-        'is front line': p.is_frontline_worker,
-        'is teacher': p.is_teacher,
-        'age': p.age,
-        'household': p.household,
-        'female': p.sex_female,
-        'covid start date': p.covid_start_date,
-        'covid end date': p.covid_end_date,
-        'where they shop': p.shopping_id,
-        'work place': p.workplace_id,
-
-
-    }
-
-
-def create_summary_dictionary(c: City):
-    res = {
-        'start_date': c.start_date.isoformat(),
-        'current_date': c.current_date.isoformat(),
-        'starting_pop': c.starting_population,
-        'current_pop': c.population,
-        'female_pop_pct': c.female_pct,
-        'male_pop_pct': 1-c.female_pct,
-        'sick': c.num_sick,
-        'recovered': c.num_recovered,
-        'uninfected': c.num_uninfected,
-        'dead': c.num_dead,
-        'vacinated': c.num_vaccinated,
-        'wasted_vaccine': c.num_wasted_vaccines,
-        'mortality_rate': c.num_dead / max(1, (c.num_dead + c.num_recovered)),
-        'infection_rate': (c.num_recovered + c.num_dead + c.num_sick) / max(1, c.starting_population),
-        'teacher_sick_rate': c.teachers_pct_sick,
-        'hospital_worker_sick_rate': c.hospital_worker_pct_sick,
-        'frontline_worker_sick_rate': c.frontline_worker_pct_sick
-    }
-    return res
-
-
-def trial(vaccine: VaccineBase, city: City, trial_num: int, days: int):
+def trial(vaccine: VaccineBase, city: City, trial_num: int, days: int, output_format: str = output_format,
+          measure: bool = False, checkpoint: bool = False):
     trial_start_time = time.perf_counter()
+    # save the city every checkpoint_every days, and carry on from there if the trial was stopped part way (only a
+    # seeded city can be made the same way again to carry on)
+    if checkpoint and city.seed is None:
+        raise ValueError(f"Can't checkpoint {city.name}: it has no seed")
+    checkpoint_path = checkpoint_dir / f'{city.name}-{vaccine.name}-{trial_num}-{city.seed}.npz' if checkpoint else None
+    if checkpoint_path is not None:
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    if measure:
+        city.metrics = CityMetrics()
     # assign the scores
     vaccine.assign_scores(city)
 
-    # Create the output directory
-    if output_dir.exists() is False:
-        output_dir.mkdir()
-
     # Output data
-    csv_file_path = output_dir / f'{city.name}-{vaccine.name}-{trial_num}.csv'
-    print(f'\t\tWriting to {csv_file_path}')
-    with csv_file_path.open('w', newline='') as csv_file:
-        # Create the file and get the initial data
-        info = create_summary_dictionary(city)
-        writer = csv.DictWriter(csv_file, fieldnames=list(info.keys()))
-        writer.writeheader()    # Write the header
-        writer.writerow(info)   # Write the initial data
-
-        # Run the simulation for this many days
-        for tick in range(1, days):
-            if tick % 30 == 0:
-                print('.', end='', flush=True)
-            city.run_timestep()
-            writer.writerow(create_summary_dictionary(city))
-
-    csv_person_info_file_path = output_dir / f'{city.name}-{vaccine.name}-person_info-{trial_num}.csv'
-    with csv_person_info_file_path.open('w', newline='') as csv_file:
-        person_info = create_person_dictionary(city.pop[0])
-        writer = csv.DictWriter(csv_file, fieldnames=list(person_info.keys()))
-        writer.writeheader()
-        for person in city.pop:
-            person_info = create_person_dictionary(person)
-            writer.writerow(person_info)
+    with make_sink(output_format, output_dir, city.name, vaccine.name, trial_num) as sink:
+        print(f'\t\tWriting to {sink.summary_path}')
+        for summary in simulate(city, days, progress=True, checkpoint=checkpoint_path,
+                                checkpoint_every=checkpoint_every):
+            with city.measure('write_summary'):
+                sink.add_summary(summary)
+        with city.measure('write_person_info'):
+            sink.add_people(city)
+    if checkpoint_path is not None:
+        checkpoint_path.unlink(missing_ok=True)
 
     print(
         f"\tCompleted trial {city.name} - {vaccine.name} #{trial_num}: "
         f"{time.perf_counter() - trial_start_time:0.2f} sec")
+    if measure:
+        # How long each phase took, in total and for each day
+        print('\t\t' + ', '.join(f'{phase}: {seconds:0.2f} sec' for phase, seconds in city.metrics.totals.items()))
+        write_csv(output_dir / f'{city.name}-{vaccine.name}-metrics-{trial_num}.csv', city.metrics.table())
 
 
 if __name__ == '__main__':
@@ -94,7 +51,10 @@ if __name__ == '__main__':
     city_size = 1000
     initial_sick = int(city_size * 0.05)
     days = 365
+    trials = 1
+    workers = None          # number of processes to run the trials on (None for one per core)
     train_ai = False
+    measure = False         # time each phase of every trial (see CityMetrics)
 
     start_time = time.perf_counter()
     random_vaccine = RandomVaccine('random_vaccine')
@@ -102,15 +62,25 @@ if __name__ == '__main__':
     ai_vaccine = VaccineAI('ai')
     if train_ai:
         # Train an AI and save it to disk
-        ai_vaccine.train(max_cycles=150)
+        ai_vaccine.train(max_cycles=150, checkpoint=checkpoint_dir / f'{ai_vaccine.name}-training.pt',
+                         checkpoint_every=checkpoint_every)
         ai_vaccine.save_nn()
     else:
         # Load the AI from disk
         ai_vaccine.load_nn()
 
-    for i in range(1):
-        trial_city = City(name='newmarket', size=city_size, initial_sick=initial_sick)
-        trial(random_vaccine, copy.deepcopy(trial_city), trial_num=i, days=days)
-        trial(no_vaccine, copy.deepcopy(trial_city), trial_num=i, days=days)
-        trial(ai_vaccine, copy.deepcopy(trial_city), trial_num=i, days=days)
+    # Every strategy gets the same cities (each trial's city is built from its own seed)
+    run_trials(
+        vaccines=[random_vaccine, no_vaccine, ai_vaccine],
+        cities=[CityConfig(name='newmarket', size=city_size, initial_sick=initial_sick)],
+        trials=trials,
+        days=days,
+        workers=workers,
+        output_dir=output_dir,
+        output_format=output_format,
+        checkpoint_dir=checkpoint_dir,
+        checkpoint_every=checkpoint_every,
+        city_cache=CityCache(city_cache_dir, max_bytes=city_cache_bytes),
+        measure=measure,
+    )
     print(f"Completed trials: {time.perf_counter() - start_time:0.2f} seconds")
@@ -0,0 +1,68 @@
+from datetime import date
+import typing as t
+import time
+
+
+class PhaseTimer:
+    """
+    Times a phase of a timestep (see CityMetrics.phase)
+    """
+    __slots__ = ('metrics', 'name', 'start_time')
+
+    def __init__(self, metrics: 'CityMetrics', name: str):
+        self.metrics = metrics
+        self.name = name
+        self.start_time = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start_time)
+
+
+class CityMetrics:
+    """
+    Measurements of a running city (see City.metrics), one row per timestep: the wall time of each phase of
+    the day in seconds, the number of sick people gone through, the interactions counted and the infections
+    they led to. Phases timed after a timestep (eg. the summary and writing the results in main.trial) are
+    added to that timestep's row
+    """
+    def __init__(self):
+        self.rows: t.List[t.Dict[str, t.Any]] = []
+        self.totals: t.Dict[str, float] = {}    # seconds spent in each phase, over every day
+
+    def start_day(self, current_date: date):
+        self.rows.append({'date': current_date.isoformat()})
+
+    def record(self, **values: t.Any):
+        """
+        Set some values in the current row
+        :param values: name -> value
+        :return:
+        """
+        self.rows[-1].update(values)
+
+    def phase(self, name: str) -> PhaseTimer:
+        """
+        Time a phase: `with metrics.phase('step4_vaccine'): ...`
+        :param name:
+        :return:
+        """
+        return PhaseTimer(self, name)
+
+    def add_time(self, name: str, seconds: float):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        if len(self.rows) > 0:
+            row = self.rows[-1]
+            row[name] = row.get(name, 0.0) + seconds
+
+    def table(self) -> t.List[t.Dict[str, t.Any]]:
+        """
+        The rows with the same columns each (0 where a row has nothing), eg. for write_csv
+        :return:
+        """
+        columns = {}
+        for row in self.rows:
+            columns.update(dict.fromkeys(row))
+        return [{column: row.get(column, 0) for column in columns} for row in self.rows]
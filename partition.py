@@ -0,0 +1,302 @@
+from population import NO_DAY
+from chance import chance_table
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+from scipy import sparse
+import multiprocessing
+import traceback
+import typing as t
+import numpy as np
+
+from settings import *
+
+if t.TYPE_CHECKING:
+    from city import City
+
+
+# The population columns the shards read. The parent process keeps changing them in place, so they are kept in shared
+# memory where every shard sees the changes
+SHARED_COLUMNS = (
+    'household', 'work', 'shopping', 'age', 'preexisting_condition',
+    'covid_immunity', 'covid_start', 'covid_end', 'sickness_level', 'is_alive', 'in_quarantine'
+)
+# (name, dtype) of the arrays (size: pop) the shards hand back their results in
+BUFFERS = (('interactions', np.int64), ('draws', np.float64))
+
+# name -> (shared memory block name, length, dtype)
+ColumnSpec = t.Dict[str, t.Tuple[str, int, str]]
+
+
+def shard_bounds(household: np.ndarray, shards: int) -> t.List[int]:
+    """
+    Split people into ranges of about the same size, without splitting a household
+    :param household: an array (size: pop) of everyone's household, where the people of a household are next to
+        each other
+    :param shards: the number of ranges
+    :return: the first person of each range, followed by the number of people
+    """
+    if np.any(household[1:] < household[:-1]):
+        raise ValueError('Households need to be contiguous to be sharded')
+    household_starts = np.flatnonzero(np.diff(household, prepend=-1) != 0)
+    targets = np.linspace(0, len(household), shards + 1)[1:-1]
+    starts = household_starts[np.minimum(np.searchsorted(household_starts, targets), len(household_starts) - 1)]
+    return sorted({0, len(household), *starts.tolist()})
+
+
+class Shard:
+    """
+    The people in one range of households (see shard_bounds), as seen by the worker process running it. Everything
+    that only depends on the shard's own people is worked out here: the interactions at home, and this shard's part
+    of the sick count at each workplace and shop. The counts from all the shards are added up by ShardPool
+    """
+    def __init__(self, columns: t.Mapping[str, np.ndarray], start: int, stop: int):
+        """
+        :param columns: the shared columns and buffers, for everyone
+        :param start: the first person in the shard
+        :param stop: one past the last person in the shard
+        """
+        self.start = start
+        self.stop = stop
+        self.columns = columns
+        self.first_household = int(columns['household'][start]) if stop > start else 0
+        self.num_households = int(columns['household'][stop - 1]) - self.first_household + 1 if stop > start else 0
+        # (people, shops) incidence matrix for the shard's people
+        shops = np.arange(MAX_SHOP_ID + 1, dtype=np.uint32)
+        self.shopping = sparse.csr_matrix(((self.column('shopping')[:, np.newaxis] >> shops) & 1).astype(np.int64))
+        self.household_sick: np.ndarray = np.zeros(0, dtype=np.int64)
+        self.vulnerable: np.ndarray = np.zeros(0, dtype=np.int64)
+
+    def column(self, name: str) -> np.ndarray:
+        return self.columns[name][self.start:self.stop]
+
+    def count_sick(self) -> t.Tuple[np.ndarray, np.ndarray]:
+        """
+        Count the shard's sick people at each location. Matches ContactNetwork.interactions
+        :return: the number of sick people in quarantine at each workplace, and of sick people at each shop
+        """
+        is_alive, covid_start, covid_end = self.column('is_alive'), self.column('covid_start'), self.column('covid_end')
+        contagious = is_alive & (covid_start != NO_DAY)
+        if not RECOVERED_ARE_CONTAGIOUS:
+            contagious &= covid_end == NO_DAY
+        sick = np.flatnonzero(contagious)
+        work = self.column('work')
+
+        # Step 1: sick people in quarantine go to their (usual) workplace
+        quarantined = sick[self.column('in_quarantine')[sick]]
+        work_sick = np.bincount(work[quarantined] - NO_WORK_ID, minlength=MAX_WORK_ID - NO_WORK_ID + 1)
+
+        # Step 2: households don't cross shards, so they are only counted here
+        self.household_sick = np.bincount(self.column('household')[sick] - self.first_household,
+                                          minlength=self.num_households)
+
+        # Step 3: sick people visit their shops and the shop matching their workplace id (once if it is both)
+        shopping_sick = np.asarray(self.shopping[sick].sum(axis=0)).ravel()
+        workplace = np.where(self.column('sickness_level')[sick] == 3, HOSPITAL_ID, work[sick])
+        is_shop = (workplace >= 0) & (workplace <= MAX_SHOP_ID)
+        visitors, workplace = sick[is_shop], workplace[is_shop]
+        visits_workplace = (self.column('shopping')[visitors] >> workplace.astype(np.uint32)) & 1 == 0
+        shopping_sick += np.bincount(workplace[visits_workplace], minlength=MAX_SHOP_ID + 1)
+        return work_sick, shopping_sick
+
+    def count_interactions(self, work_sick: np.ndarray, shopping_sick: np.ndarray) -> int:
+        """
+        Count the interactions of the shard's people into the shared interactions buffer
+        :param work_sick: the number of sick people in quarantine at each workplace, over every shard
+        :param shopping_sick: the number of sick people at each shop, over every shard
+        :return: the number of vulnerable people in the shard
+        """
+        interactions = WORK_INTERACTIONS * work_sick[self.column('work') - NO_WORK_ID]
+        interactions += HOME_INTERACTIONS * self.household_sick[self.column('household') - self.first_household]
+        interactions += SHOPPING_INTERACTIONS * (self.shopping @ shopping_sick)
+
+        # Only vulnerable people pick up interactions
+        is_vulnerable = self.column('is_alive') & (self.column('covid_start') == NO_DAY)
+        interactions[~is_vulnerable] = 0
+        self.column('interactions')[:] = interactions
+        self.vulnerable = np.flatnonzero(is_vulnerable)
+        return len(self.vulnerable)
+
+    def infections(self, offset: int) -> np.ndarray:
+        """
+        Find who catches covid, with the shard's part of the random draws (see ShardPool.infections)
+        :param offset: where the shard's draws start in the shared draws buffer
+        :return: index of the people infected
+        """
+        vulnerable = self.vulnerable
+        probability = chance_table().lookup(
+            self.column('interactions')[vulnerable], self.column('age')[vulnerable],
+            self.column('preexisting_condition')[vulnerable], self.column('covid_immunity')[vulnerable]
+        )
+        draws = self.columns['draws'][offset:offset + len(vulnerable)]
+        return self.start + vulnerable[draws < probability]
+
+
+def run_shard(connection: Connection, columns: ColumnSpec, start: int, stop: int):
+    """
+    Worker process: run the commands sent by ShardPool on a shard until it is told to stop
+    :param connection: the worker's end of the pipe to the ShardPool
+    :param columns: the shared memory blocks holding the columns
+    :param start: see Shard
+    :param stop: see Shard
+    :return:
+    """
+    # the worker shares its parent's resource tracker, so the blocks are still removed if the parent dies
+    blocks = {name: shared_memory.SharedMemory(name=block_name) for name, (block_name, _, _) in columns.items()}
+    arrays = {name: np.ndarray(length, dtype=dtype, buffer=blocks[name].buf)
+              for name, (_, length, dtype) in columns.items()}
+    shard = Shard(arrays, start, stop)
+    commands = {
+        'count_sick': shard.count_sick,
+        'count_interactions': shard.count_interactions,
+        'infections': shard.infections,
+    }
+    try:
+        while True:
+            command, args = connection.recv()
+            if command == 'close':
+                break
+            try:
+                connection.send((True, commands[command](*args)))
+            except Exception:
+                connection.send((False, traceback.format_exc()))
+    finally:
+        del shard, arrays
+        for block in blocks.values():
+            block.close()
+        connection.close()
+
+
+class ShardPool:
+    """
+    Runs the O(pop) parts of a vectorized city's timestep on worker processes, each holding a range of households
+    (see City.partition). The columns the workers read are moved into shared memory, and the parent process keeps
+    changing them in place as it always does.
+
+    Each day the shards count the sick people at each location among their own people. Households don't cross shards,
+    so each shard counts the interactions at home by itself, and the counts at each workplace and shop are added up
+    across the shards, then handed back so every shard can count its people's interactions there. Infections are
+    drawn in the parent with the city's random number generator (the same draws, in the same order, as a single
+    process), then each shard compares its part of them with its people's chances. The vaccines and the changes in
+    people's health are still done by the parent, they only cost as much as the people they change.
+    """
+    def __init__(self, city: 'City', shards: int):
+        """
+        :param city: a vectorized city
+        :param shards: the number of worker processes
+        """
+        if shards < 1:
+            raise ValueError(f'Need at least one shard, not {shards}')
+        self.city = city
+        pop = city.pop
+        self.blocks: t.Dict[str, shared_memory.SharedMemory] = {}
+        self.arrays: t.Dict[str, np.ndarray] = {}
+        columns = [(name, getattr(pop, name).dtype) for name in SHARED_COLUMNS] + list(BUFFERS)
+        for name, dtype in columns:
+            dtype = np.dtype(dtype)
+            block = shared_memory.SharedMemory(create=True, size=max(1, len(pop) * dtype.itemsize))
+            self.blocks[name] = block
+            self.arrays[name] = np.ndarray(len(pop), dtype=dtype, buffer=block.buf)
+        self.share()
+
+        bounds = shard_bounds(pop.household, shards)
+        spec = {name: (self.blocks[name].name, len(pop), array.dtype.str) for name, array in self.arrays.items()}
+        context = multiprocessing.get_context()
+        self.connections: t.List[Connection] = []
+        self.processes = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            parent_end, worker_end = context.Pipe()
+            process = context.Process(target=run_shard, args=(worker_end, spec, start, stop), daemon=True)
+            process.start()
+            worker_end.close()
+            self.connections.append(parent_end)
+            self.processes.append(process)
+        self.vulnerable: t.List[int] = [0] * len(self.connections)   # the number of vulnerable people in each shard
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def __enter__(self) -> 'ShardPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def share(self):
+        """
+        Copy the population's columns into shared memory and have the population use the shared copies (again after
+        its state was replaced, see City.restore)
+        :return:
+        """
+        pop = self.city.pop
+        for name in SHARED_COLUMNS:
+            shared = self.arrays[name]
+            column = getattr(pop, name)
+            if column is not shared:
+                shared[:] = column
+                setattr(pop, name, shared)
+
+    def run(self, command: str, *args_for_each: t.Sequence) -> t.List[t.Any]:
+        """
+        Run a command on every shard at once
+        :param command: a Shard method
+        :param args_for_each: for each argument, its value for each shard
+        :return: what each shard returned
+        """
+        for connection, args in zip(self.connections, zip(*args_for_each) if args_for_each else
+                                    [()] * len(self.connections)):
+            connection.send((command, args))
+        results = []
+        for connection in self.connections:
+            ok, result = connection.recv()
+            if not ok:
+                raise RuntimeError(f'Shard failed to {command}:\n{result}')
+            results.append(result)
+        return results
+
+    def interactions(self) -> np.ndarray:
+        """
+        Count the interactions everyone has with sick people today. Matches ContactNetwork.interactions
+        :return: an array (size: pop) of all the interactions with sick people from the city, in shared memory (it is
+            overwritten the next day)
+        """
+        counts = self.run('count_sick')
+        work_sick = sum(work for work, _ in counts)
+        shopping_sick = sum(shopping for _, shopping in counts)
+        self.vulnerable = self.run(
+            'count_interactions', [work_sick] * len(self), [shopping_sick] * len(self))
+        return self.arrays['interactions']
+
+    def infections(self, rng: np.random.Generator) -> np.ndarray:
+        """
+        Find who catches covid today, after interactions(). Matches City.step5_health_update_batched
+        :param rng: the city's random number generator, one number is drawn for each vulnerable person
+        :return: index of the people infected, in index order
+        """
+        offsets = np.cumsum([0] + self.vulnerable)
+        rng.random(out=self.arrays['draws'][:offsets[-1]])
+        infected = self.run('infections', offsets[:-1].tolist())
+        return np.concatenate(infected) if len(infected) > 0 else np.zeros(0, dtype=np.int64)
+
+    def close(self):
+        """
+        Stop the worker processes and give the population its own copy of the shared columns back
+        :return:
+        """
+        for connection in self.connections:
+            connection.send(('close', ()))
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections, self.processes = [], []
+
+        pop = self.city.pop
+        for name in SHARED_COLUMNS:
+            if getattr(pop, name) is self.arrays[name]:
+                setattr(pop, name, self.arrays[name].copy())
+        if self.city.shards is self:
+            self.city.shards = None
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
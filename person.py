@@ -1,34 +1,121 @@
-import dataclasses
+from chance import chance_table
 from datetime import date
 import typing as t
 import random
 
 from settings import *
 
+if t.TYPE_CHECKING:
+    from population import Population
+
+
+def chance_of_getting_covid(num_interactions: int, age: int, preexisting_condition: bool,
+                            covid_immunity: float) -> float:
+    """
+    Determine the chance of a person getting COVID after a number of interactions
+    :param num_interactions:
+    :param age:
+    :param preexisting_condition:
+    :param covid_immunity: 0 = vulnerable, 1 = immune
+    :return:
+    """
+    return chance_table().chance(num_interactions, age, preexisting_condition, covid_immunity)
+
+
+class _Column:
+    """
+    Exposes one column of the population store as an attribute of a Person view
+    """
+    def __init__(self, column: str):
+        self.column = column
+
+    def __get__(self, person: 'Person', owner=None):
+        if person is None:
+            return self
+        return getattr(person._pop, self.column)[person._idx].item()
+
+    def __set__(self, person: 'Person', value):
+        getattr(person._pop, self.column)[person._idx] = value
+
+
+class _DateColumn(_Column):
+    """
+    Exposes a day offset column of the population store as a date (or None if not set)
+    """
+    def __get__(self, person: 'Person', owner=None):
+        if person is None:
+            return self
+        return person._pop.to_date(getattr(person._pop, self.column)[person._idx])
+
+    def __set__(self, person: 'Person', value: t.Optional[date]):
+        getattr(person._pop, self.column)[person._idx] = person._pop.to_day(value)
+
+
+class _DayColumn(_Column):
+    """
+    Exposes a day offset column of the population store as an int (or None if not set)
+    """
+    def __get__(self, person: 'Person', owner=None):
+        if person is None:
+            return self
+        day = getattr(person._pop, self.column)[person._idx].item()
+        return None if day == person._pop.NO_DAY else day
+
+
+class _ShoppingColumn(_Column):
+    """
+    Exposes the shopping bitmask of the population store as a set of shop ids
+    """
+    def __get__(self, person: 'Person', owner=None):
+        if person is None:
+            return self
+        return person._pop.shops_of(person._idx)
+
+    def __set__(self, person: 'Person', value: t.Set[int]):
+        person._pop.shopping[person._idx] = person._pop.shop_bits(value)
+
 
-@dataclasses.dataclass
 class Person:
+    """
+    A lightweight view of one person in a Population. Reading or writing an attribute reads or writes
+    the matching entry of the population's arrays
+    """
+    __slots__ = ('_pop', '_idx')
+
     # demographics
-    household: int
-    work: int
-    shopping: t.Set[int]
-    age: int
-    sex_female: bool                                         # True for female, False for male
-    preexisting_condition: bool = False
+    household: int = _Column('household')
+    work: int = _Column('work')
+    shopping: t.Set[int] = _ShoppingColumn('shopping')
+    age: int = _Column('age')
+    sex_female: bool = _Column('sex_female')                                # True for female, False for male
+    preexisting_condition: bool = _Column('preexisting_condition')
 
     # medical info
-    initially_sick: bool = False                              # True if initially sick (in setup) or False otherwise
-    vaccine_score: float = -1.0                               # -1 = no vaccine, otherwise [0, 1]
-    is_vaccinated: bool = False                               # True if vaccinated, False otherwise
-    vaccine_wasted: bool = False                              # True if given vaccine but already infected
-    covid_immunity: float = 0                                 # 0 = vulnerable, 1 = immune
-    covid_start_date: t.Optional[date] = None                 # date they first get covid
-    covid_end_date: t.Optional[date] = None                   # date they recovered (or the date they died)
-    vaccine_date: t.Optional[date] = None                     # date they got the covid vaccine
-    visible_symptoms: bool = False                            # has visible symptoms
-    sickness_level: int = 0                                   # 0 = no symptoms, 1 = mild, 2 = medium, 3 = high
-    is_alive: bool = True
-    in_quarantine: bool = False
+    initially_sick: bool = _Column('initially_sick')                        # True if initially sick (in setup)
+    vaccine_score: float = _Column('vaccine_score')                         # -1 = no vaccine, otherwise [0, 1]
+    is_vaccinated: bool = _Column('is_vaccinated')                          # True if vaccinated, False otherwise
+    vaccine_wasted: bool = _Column('vaccine_wasted')                        # True if given vaccine but already infected
+    covid_immunity: float = _Column('covid_immunity')                       # 0 = vulnerable, 1 = immune
+    covid_start_date: t.Optional[date] = _DateColumn('covid_start')         # date they first get covid
+    covid_end_date: t.Optional[date] = _DateColumn('covid_end')             # date they recovered (or died)
+    vaccine_date: t.Optional[date] = _DateColumn('vaccine_day')             # date they got the covid vaccine
+    covid_start_day: t.Optional[int] = _DayColumn('covid_start')            # the same as day offsets
+    covid_end_day: t.Optional[int] = _DayColumn('covid_end')
+    visible_symptoms: bool = _Column('visible_symptoms')                    # has visible symptoms
+    sickness_level: int = _Column('sickness_level')                         # 0 = none, 1 = mild, 2 = medium, 3 = high
+    is_alive: bool = _Column('is_alive')
+    in_quarantine: bool = _Column('in_quarantine')
+
+    def __init__(self, population: 'Population', idx: int):
+        self._pop = population
+        self._idx = idx
+
+    def __repr__(self) -> str:
+        return f'Person(idx={self._idx}, age={self.age}, household={self.household}, work={self.work})'
+
+    @property
+    def idx(self) -> int:
+        return self._idx
 
     # Information ------------------------------------------------------------------------------------------------------
     @property
@@ -59,9 +146,17 @@ class Person:
         """
         return self.was_sick and self.is_alive
 
+    @property
+    def is_contagious(self) -> bool:
+        """
+        Can currently spread covid
+        :return:
+        """
+        return self.is_infected if RECOVERED_ARE_CONTAGIOUS else self.is_currently_sick
+
     @property
     def is_contagious_outside_home(self) -> bool:
-        return self.is_infected and not self.in_quarantine
+        return self.is_contagious and not self.in_quarantine
 
     @property
     def is_currently_sick(self) -> bool:
@@ -99,50 +194,36 @@ class Person:
         :param num_interactions:
         :return:
         """
-        probability = (1 + CHANGE_OF_GETTING_SICK_FROM_INTERACTION) ** num_interactions - 1
-
-        # adjust for age
-        if self.age >= 70:
-            probability *= 2.0
-        elif self.age >= 50:
-            probability *= 1.5
-        elif self.age >= 30:
-            probability *= 1.1
-
-        # adjust for pre-existing conditions
-        if self.preexisting_condition:
-            probability *= 2
-
-        # Adjust for immunity factor
-        probability *= (1 - self.covid_immunity)
-        return probability
+        return chance_of_getting_covid(num_interactions, self.age, self.preexisting_condition, self.covid_immunity)
 
     # Actions ----------------------------------------------------------------------------------------------------------
     def infect(self, dt: date):
-        if self.covid_start_date is None:
-            self.covid_start_date = dt
+        self._pop.infect(self._idx, self._pop.to_day(dt))
 
     def vaccinate(self):
-        self.is_vaccinated = True
-        self.covid_immunity = 1.0
-        self.vaccine_wasted = self.is_infected   # if vaccinated, but was previously infected, then vaccine is wasted
+        self._pop.vaccinate(self._idx)
 
     def kill(self, dt: date):
-        self.is_alive = False
-        self.covid_end_date = dt
+        self._pop.kill(self._idx, self._pop.to_day(dt))
+
+    def quarantine(self):
+        self._pop.quarantine(self._idx)
 
     def recover(self, dt: date):
-        self.is_alive = True
-        self.covid_end_date = dt
-        self.covid_immunity = 1.0
-        self.in_quarantine = False
+        self._pop.recover(self._idx, self._pop.to_day(dt))
 
-    def update_health(self, current_date: date):
-        if self.covid_end_date is not None:
+    def update_health(self, current_date: date, rand: random.Random = random):
+        """
+        Move the person along the stages of the disease
+        :param current_date:
+        :param rand: where to draw random numbers from (default: the global `random` state)
+        :return:
+        """
+        if self.covid_end_day is not None:
             return
-        if self.covid_start_date is None:
+        if self.covid_start_day is None:
             return
-        days_since_infection = (current_date - self.covid_start_date).days
+        days_since_infection = self._pop.to_day(current_date) - self.covid_start_day
 
         # Adjust for health factors
         health_factor = 1.5 if self.preexisting_condition else 1.0
@@ -154,23 +235,23 @@ class Person:
         elif days_since_infection == 5:
             self.visible_symptoms = True
         elif days_since_infection == 10:
-            if random.random() * health_factor < RECOVERY_RATE_STAGE_0:
+            if rand.random() * health_factor < RECOVERY_RATE_STAGE_0:
                 self.recover(current_date)
                 return
             self.sickness_level = 1
-            self.in_quarantine = True
+            self.quarantine()
         elif days_since_infection == 15:
-            if random.random() * health_factor < RECOVERY_RATE_STAGE_1:
+            if rand.random() * health_factor < RECOVERY_RATE_STAGE_1:
                 self.recover(current_date)
                 return
             self.sickness_level = 2
         elif days_since_infection == 24:
-            if random.random() * health_factor < RECOVERY_RATE_STAGE_2:
+            if rand.random() * health_factor < RECOVERY_RATE_STAGE_2:
                 self.recover(current_date)
                 return
             self.sickness_level = 3
         elif days_since_infection == 35:
-            if random.random() * health_factor < RECOVERY_RATE_STAGE_3:
+            if rand.random() * health_factor < RECOVERY_RATE_STAGE_3:
                 self.recover(current_date)
                 return
             self.kill(current_date)
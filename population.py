@@ -0,0 +1,394 @@
+from person import Person
+from chance import chance_table
+from datetime import date, timedelta
+import typing as t
+import numpy as np
+
+from settings import *
+
+
+NO_DAY = np.iinfo(np.int16).min     # day offset used when a date is not set (ie. None)
+
+
+class Population:
+    """
+    Columnar store holding everyone in a city. Each attribute of a person is kept in its own
+    NumPy array, indexed by the person's position in the city. Dates are stored as integer day
+    offsets from start_date (NO_DAY when the date is not set), which fit in an int16 (about 89 years either
+    side of the start date), and where people shop as a bitmask (bit n is set if they shop at shop n).
+
+    Indexing the population (pop[idx]) or iterating over it returns lightweight Person views
+    that read and write straight into these arrays.
+    """
+    # who people are and where they go, fixed once the city is set up
+    DEMOGRAPHIC_COLUMNS = (
+        'household', 'work', 'shopping', 'age', 'sex_female', 'preexisting_condition', 'initially_sick'
+    )
+    # everything that changes while the simulation runs
+    STATE_COLUMNS = (
+        'vaccine_score', 'is_vaccinated', 'vaccine_wasted', 'covid_immunity', 'covid_start', 'covid_end',
+        'vaccine_day', 'visible_symptoms', 'sickness_level', 'is_alive', 'in_quarantine'
+    )
+
+    # days after infection when the disease moves on to its next stage (see Person.update_health)
+    STAGE_DAYS = (3, 5, 10, 15, 24, 35)
+
+    NO_DAY = NO_DAY     # for Person, which can't import this module
+
+    def __init__(self, size: int = 0, start_date: date = date(2021, 1, 1)):
+        self.start_date: date = start_date
+
+        # demographics
+        self.household = np.zeros(size, dtype=np.int32)
+        self.work = np.full(size, NO_WORK_ID, dtype=np.int16)
+        self.shopping = np.zeros(size, dtype=np.uint32)     # bit n set = shops at shop n (see shopping_matrix)
+        self.age = np.zeros(size, dtype=np.int16)
+        self.sex_female = np.zeros(size, dtype=bool)
+        self.preexisting_condition = np.zeros(size, dtype=bool)
+
+        # medical info
+        self.initially_sick = np.zeros(size, dtype=bool)
+        self.vaccine_score = np.full(size, -1.0, dtype=np.float64)
+        self.is_vaccinated = np.zeros(size, dtype=bool)
+        self.vaccine_wasted = np.zeros(size, dtype=bool)
+        self.covid_immunity = np.zeros(size, dtype=np.float32)
+        self.covid_start = np.full(size, NO_DAY, dtype=np.int16)
+        self.covid_end = np.full(size, NO_DAY, dtype=np.int16)
+        self.vaccine_day = np.full(size, NO_DAY, dtype=np.int16)
+        self.visible_symptoms = np.zeros(size, dtype=bool)
+        self.sickness_level = np.zeros(size, dtype=np.int8)
+        self.is_alive = np.ones(size, dtype=bool)
+        self.in_quarantine = np.zeros(size, dtype=bool)
+
+        # objects told before and after the actions below change someone (eg. CityStats). Each one has
+        # before_change(idx) and after_change(idx) methods
+        self.observers: t.List[t.Any] = []
+
+    @classmethod
+    def from_columns(cls, start_date: date, **columns: t.Sequence) -> 'Population':
+        """
+        Build a population from a set of equal length columns. Any column not given keeps its default
+        :param start_date: the date that day offsets are measured from
+        :param columns: column name -> values, one per person. shopping is a sequence of sets of shop ids
+        :return:
+        """
+        size = len(next(iter(columns.values()))) if columns else 0
+        pop = cls(size=size, start_date=start_date)
+        for name, values in columns.items():
+            if name == 'shopping':
+                pop.shopping[:] = [pop.shop_bits(shops) for shops in values]
+            else:
+                getattr(pop, name)[:] = values
+        return pop
+
+    @classmethod
+    def generate(cls, size: int, rng: np.random.Generator, start_date: date = date(2021, 1, 1)) -> 'Population':
+        """
+        Generate the people of a city, all at once. Uses the same distributions as City.add_people: households
+        of 1-4 adults followed by 0-3 kids, filled until there are enough people
+        :param size: number of people
+        :param rng: random number generator
+        :param start_date: the date that day offsets are measured from
+        :return:
+        """
+        # Draw households until there are enough people (they average 4 people each)
+        adults, kids = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        while adults.sum() + kids.sum() < size:
+            num_households = (size - adults.sum() - kids.sum()) // 4 + 16
+            adults = np.concatenate([adults, rng.integers(1, 5, num_households)])
+            kids = np.concatenate([kids, rng.integers(0, 4, num_households)])
+        household_size = adults + kids
+        household = np.repeat(np.arange(len(household_size)), household_size)[:size]
+        household_start = np.cumsum(household_size) - household_size
+        is_adult = (np.arange(size) - household_start[household]) < adults[household]
+
+        pop = cls(size=size, start_date=start_date)
+        pop.household[:] = household
+        pop.age[:] = np.where(is_adult, rng.integers(18, 66, size), rng.integers(0, 19, size))
+
+        random_value = rng.random(size)
+        adult_work = np.select(
+            [random_value < 0.04, random_value < 0.08, random_value < (0.08 + 0.10)],
+            [HOSPITAL_ID, SCHOOL_ID, FRONTLINE_ID],
+            default=rng.integers(FRONTLINE_ID + 1, MAX_WORK_ID + 1, size)
+        )
+        kid_work = np.where(pop.age > 5, SCHOOL_ID, NO_WORK_ID)
+        pop.work[:] = np.where(is_adult, adult_work, kid_work)
+
+        # Adults make 6 trips to random shops and kids make 2
+        trips = rng.integers(0, MAX_SHOP_ID + 1, (size, 6))
+        made_trip = np.arange(6) < np.where(is_adult, 6, 2)[:, np.newaxis]
+        people, _ = np.nonzero(made_trip)
+        np.bitwise_or.at(pop.shopping, people, np.left_shift(1, trips[made_trip]).astype(np.uint32))
+
+        chance_of_condition = np.where(is_adult & (pop.age >= 50), 0.10, 0.05)
+        pop.preexisting_condition[:] = rng.random(size) < chance_of_condition
+        pop.sex_female[:] = rng.random(size) >= 0.5
+        return pop
+
+    def clone(self) -> 'Population':
+        """
+        Copy the population. The demographic columns are shared with the copy (and made read-only), only the
+        state columns are copied. Observers are not copied
+        :return:
+        """
+        pop = Population.__new__(Population)
+        pop.start_date = self.start_date
+        for name in self.DEMOGRAPHIC_COLUMNS:
+            column = getattr(self, name)
+            column.flags.writeable = False
+            setattr(pop, name, column)
+        pop.set_state(self.get_state())
+        pop.observers = []
+        return pop
+
+    def rows(self, people: slice) -> 'Population':
+        """
+        A range of the people, sharing the columns with this population (nothing is copied). Observers are not
+        told about changes made through it
+        :param people: eg. slice(start, stop)
+        :return:
+        """
+        pop = Population.__new__(Population)
+        pop.start_date = self.start_date
+        for name in self.DEMOGRAPHIC_COLUMNS + self.STATE_COLUMNS:
+            setattr(pop, name, getattr(self, name)[people])
+        pop.observers = []
+        return pop
+
+    def get_state(self) -> t.Dict[str, np.ndarray]:
+        """
+        A copy of the state columns
+        :return: column name -> array
+        """
+        return {name: getattr(self, name).copy() for name in self.STATE_COLUMNS}
+
+    def set_state(self, state: t.Dict[str, np.ndarray]):
+        """
+        Replace the state columns with a copy of the ones given (see get_state). Observers are not told, they
+        need to be reset
+        :param state: column name -> array
+        :return:
+        """
+        for name in self.STATE_COLUMNS:
+            setattr(self, name, state[name].copy())
+
+    def __len__(self) -> int:
+        return len(self.age)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory used by the columns (the Person views don't hold anything of their own)
+        :return:
+        """
+        return sum(getattr(self, name).nbytes for name in self.DEMOGRAPHIC_COLUMNS + self.STATE_COLUMNS)
+
+    def __getitem__(self, idx: int) -> Person:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'person {idx} is out of range')
+        return Person(self, idx)
+
+    def __iter__(self) -> t.Iterator[Person]:
+        for idx in range(len(self)):
+            yield Person(self, idx)
+
+    # Dates ------------------------------------------------------------------------------------------------------------
+    def to_day(self, dt: t.Optional[date]) -> int:
+        return NO_DAY if dt is None else (dt - self.start_date).days
+
+    def to_date(self, day: int) -> t.Optional[date]:
+        return None if day == NO_DAY else self.start_date + timedelta(days=int(day))
+
+    # Information (one entry per person) -------------------------------------------------------------------------------
+    @property
+    def is_teacher(self) -> np.ndarray:
+        return (self.age >= 18) & (self.work == SCHOOL_ID)
+
+    @property
+    def is_hospital_worker(self) -> np.ndarray:
+        return (self.age >= 18) & (self.work == HOSPITAL_ID)
+
+    @property
+    def is_frontline_worker(self) -> np.ndarray:
+        return (self.age >= 18) & (self.work == FRONTLINE_ID)
+
+    @property
+    def was_sick(self) -> np.ndarray:
+        return self.covid_start != NO_DAY
+
+    @property
+    def is_infected(self) -> np.ndarray:
+        return self.was_sick & self.is_alive
+
+    @property
+    def is_contagious(self) -> np.ndarray:
+        return self.is_infected if RECOVERED_ARE_CONTAGIOUS else self.is_currently_sick
+
+    @property
+    def is_contagious_outside_home(self) -> np.ndarray:
+        return self.is_contagious & ~self.in_quarantine
+
+    @property
+    def is_currently_sick(self) -> np.ndarray:
+        return self.is_alive & (self.covid_start != NO_DAY) & (self.covid_end == NO_DAY)
+
+    @property
+    def is_vulnerable(self) -> np.ndarray:
+        return self.is_alive & (self.covid_start == NO_DAY)
+
+    @property
+    def is_recovered(self) -> np.ndarray:
+        return self.is_alive & (self.covid_start != NO_DAY) & (self.covid_end != NO_DAY)
+
+    @property
+    def workplace_id(self) -> np.ndarray:
+        workplace = self.work.astype(np.int16)
+        workplace[self.sickness_level == 3] = HOSPITAL_ID
+        workplace[~self.is_alive] = NO_WORK_ID
+        return workplace
+
+    def shops_of(self, idx: int) -> t.Set[int]:
+        """
+        The set of places a person shops at
+        :param idx: index of the person
+        :return:
+        """
+        bits = int(self.shopping[idx])
+        return {shop for shop in range(MAX_SHOP_ID + 1) if bits >> shop & 1}
+
+    @staticmethod
+    def shop_bits(shops: t.Iterable[int]) -> int:
+        """
+        The bitmask for a set of shops (see shopping)
+        :param shops: shop ids
+        :return:
+        """
+        return sum(1 << shop for shop in set(shops))
+
+    def shopping_matrix(self) -> np.ndarray:
+        """
+        Where everyone shops as a (pop, shops) boolean array, True where a person shops at a shop
+        :return:
+        """
+        shops = np.arange(MAX_SHOP_ID + 1, dtype=np.uint32)
+        return ((self.shopping[:, np.newaxis] >> shops) & 1).astype(bool)
+
+    def chance_of_getting_covid(self, interactions: np.ndarray) -> np.ndarray:
+        """
+        Determine everyone's chance of getting COVID after their number of interactions. Matches
+        Person.chance_of_getting_covid
+        :param interactions: an array (size: pop) of all the interactions with sick people from the city
+        :return: an array (size: pop) of probabilities
+        """
+        return chance_table().lookup(interactions, self.age, self.preexisting_condition, self.covid_immunity)
+
+    # Actions (idx can be a single person or an array of people) -------------------------------------------------------
+    def _before_change(self, idx: t.Union[int, np.ndarray]):
+        for observer in self.observers:
+            observer.before_change(idx)
+
+    def _after_change(self, idx: t.Union[int, np.ndarray]):
+        for observer in self.observers:
+            observer.after_change(idx)
+
+    def infect(self, idx: t.Union[int, np.ndarray], day: int):
+        self._before_change(idx)
+        self.covid_start[idx] = np.where(self.covid_start[idx] == NO_DAY, day, self.covid_start[idx])
+        self._after_change(idx)
+
+    def vaccinate(self, idx: t.Union[int, np.ndarray]):
+        self._before_change(idx)
+        self.is_vaccinated[idx] = True
+        self.covid_immunity[idx] = 1.0
+        # if vaccinated, but was previously infected, then vaccine is wasted
+        self.vaccine_wasted[idx] = (self.covid_start[idx] != NO_DAY) & self.is_alive[idx]
+        self._after_change(idx)
+
+    def kill(self, idx: t.Union[int, np.ndarray], day: int):
+        self._before_change(idx)
+        self.is_alive[idx] = False
+        self.covid_end[idx] = day
+        self._after_change(idx)
+
+    def quarantine(self, idx: t.Union[int, np.ndarray]):
+        self._before_change(idx)
+        self.in_quarantine[idx] = True
+        self._after_change(idx)
+
+    def recover(self, idx: t.Union[int, np.ndarray], day: int):
+        self._before_change(idx)
+        self.is_alive[idx] = True
+        self.covid_end[idx] = day
+        self.covid_immunity[idx] = 1.0
+        self.in_quarantine[idx] = False
+        self._after_change(idx)
+
+    def update_health(self, day: int, rng: np.random.Generator, sick: t.Optional[np.ndarray] = None):
+        """
+        Move everyone who is currently sick along the stages of the disease. Matches Person.update_health
+        :param day: the current day offset
+        :param rng: random number generator used for the recovery draws
+        :param sick: index of the currently sick people to update, in index order (default: all of them). Only
+            the ones who reach a stage today change (see ProgressionSchedule)
+        :return:
+        """
+        if sick is None:
+            sick = np.flatnonzero(self.is_currently_sick)
+        days_since_infection = day - self.covid_start[sick]
+        for stage_day in self.STAGE_DAYS:
+            self.advance(sick[days_since_infection == stage_day], stage_day, day, rng)
+
+    def fast_forward(self, people: np.ndarray, rng: np.random.Generator):
+        """
+        Apply all the stages of the disease that people infected before the start date have already been
+        through, as if update_health had been run on each of those days
+        :param people: index of the people
+        :param rng: random number generator used for the recovery draws
+        :return:
+        """
+        for stage_day in self.STAGE_DAYS:
+            still_sick = people[self.is_alive[people] & (self.covid_end[people] == NO_DAY)]
+            reached = still_sick[self.covid_start[still_sick] + stage_day < 0]
+            self.advance(reached, stage_day, self.covid_start[reached] + stage_day, rng)
+
+    def advance(self, people: np.ndarray, stage_day: int, day: t.Union[int, np.ndarray], rng: np.random.Generator):
+        """
+        Apply the change in health that happens a number of days after infection
+        :param people: index of the people who have been sick for stage_day days
+        :param stage_day: one of STAGE_DAYS
+        :param day: the day offset it happens on (the same for everyone or one per person)
+        :param rng: random number generator used for the recovery draws
+        :return:
+        """
+        if len(people) == 0:
+            return
+        if stage_day == 3:
+            self.sickness_level[people] = 0
+            self.visible_symptoms[people] = False
+            return
+        if stage_day == 5:
+            self.visible_symptoms[people] = True
+            return
+
+        # Recover (or else get worse)
+        stage = self.STAGE_DAYS.index(stage_day) - 2
+        recovery_rate = [RECOVERY_RATE_STAGE_0, RECOVERY_RATE_STAGE_1, RECOVERY_RATE_STAGE_2, RECOVERY_RATE_STAGE_3]
+        recovery_rate = recovery_rate[stage]
+        day = np.broadcast_to(day, people.shape)
+
+        # Adjust for health factors
+        health_factor = np.where(self.preexisting_condition[people], 1.5, 1.0)
+        health_factor *= np.where(self.age[people] >= 65, 1.5, 1.0)
+        recovered = rng.random(len(people)) * health_factor < recovery_rate
+        self.recover(people[recovered], day[recovered])
+
+        worse = people[~recovered]
+        if stage < 3:
+            self.sickness_level[worse] = stage + 1
+            if stage == 0:
+                self.quarantine(worse)
+        else:
+            self.kill(worse, day[~recovered])
@@ -0,0 +1,91 @@
+from population import Population, NO_DAY
+import typing as t
+import numpy as np
+
+
+class ProgressionSchedule:
+    """
+    Calendar of the days when people's disease moves on to its next stage (Population.STAGE_DAYS after they
+    were infected). When someone is infected, each of their stage days is added to the calendar, so each
+    day only the people with something due are updated instead of everyone who is sick.
+
+    Like CityStats it is kept up to date by the Population actions. People who recover or die before a
+    stage day are dropped when that day comes.
+    """
+    def __init__(self, pop: Population, day: int = 0):
+        """
+        :param pop:
+        :param day: the current day offset (stage days before it have already happened)
+        """
+        self.pop = pop
+        self.calendar: t.Dict[int, t.List[np.ndarray]] = {}    # day -> the people with a stage due that day
+        self.scheduled: np.ndarray = np.zeros(len(pop), dtype=bool)
+        self.day = day
+        self.reset(day)
+        pop.observers.append(self)
+
+    def reset(self, day: int):
+        """
+        Rebuild the calendar with a full scan (eg. after the population's state was replaced)
+        :param day: the current day offset
+        :return:
+        """
+        self.calendar = {}
+        self.scheduled[:] = False
+        self.day = day
+        self.after_change(np.flatnonzero(self.pop.is_currently_sick))
+        self.scheduled[:] = self.pop.was_sick
+
+    def clone(self, pop: Population) -> 'ProgressionSchedule':
+        """
+        Copy the calendar for a copy of the population (see Population.clone)
+        :param pop: the copy of the population
+        :return:
+        """
+        schedule = ProgressionSchedule.__new__(ProgressionSchedule)
+        schedule.pop = pop
+        schedule.calendar = {day: list(people) for day, people in self.calendar.items()}
+        schedule.scheduled = self.scheduled.copy()
+        schedule.day = self.day
+        pop.observers.append(schedule)
+        return schedule
+
+    def currently_sick(self, idx: np.ndarray) -> np.ndarray:
+        """
+        Population.is_currently_sick for some people only
+        :param idx:
+        :return:
+        """
+        pop = self.pop
+        return pop.is_alive[idx] & (pop.covid_start[idx] != NO_DAY) & (pop.covid_end[idx] == NO_DAY)
+
+    def before_change(self, idx: t.Union[int, np.ndarray]):
+        pass
+
+    def after_change(self, idx: t.Union[int, np.ndarray]):
+        idx = np.atleast_1d(idx)
+        infected = idx[~self.scheduled[idx]]
+        infected = infected[self.currently_sick(infected)]
+        if len(infected) == 0:
+            return
+        self.scheduled[infected] = True
+        covid_start = self.pop.covid_start[infected]
+        for stage_day in Population.STAGE_DAYS:
+            days = covid_start + stage_day
+            for day in np.unique(days[days >= self.day]).tolist():
+                self.calendar.setdefault(day, []).append(infected[days == day])
+
+    def pop_due(self, day: int) -> np.ndarray:
+        """
+        Take the people with a stage due today off the calendar
+        :param day: the current day offset
+        :return: index of the people who are still sick and reach a stage today, in index order
+        """
+        for skipped_day in [skipped_day for skipped_day in self.calendar if skipped_day < day]:
+            del self.calendar[skipped_day]   # days jumped over (see City.skip_idle_days), when nobody was sick
+        self.day = day
+        due = self.calendar.pop(day, [])
+        if len(due) == 0:
+            return np.zeros(0, dtype=np.int64)
+        people = np.unique(np.concatenate(due))
+        return people[self.currently_sick(people)]
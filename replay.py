@@ -0,0 +1,80 @@
+import typing as t
+import pathlib
+import os
+import numpy as np
+
+
+class ReplayDataset:
+    """
+    Simulated training cities kept on disk so they can be trained on again, one .npz file per city holding
+    every feature column (see features.feature_columns) and the outcomes ('actual', see outcome_labels).
+    Cities are keyed by how they were built (see TrainingJob.key). Once there are more than max_cities, the
+    oldest ones are deleted
+    """
+    def __init__(self, path: pathlib.Path, max_cities: int = 1000):
+        """
+        :param path: the directory to keep the cities in (made if needed, and reused if it exists)
+        :param max_cities: the most cities to keep
+        """
+        self.path = path
+        self.max_cities = max_cities
+        path.mkdir(parents=True, exist_ok=True)
+        # oldest first
+        files = sorted(
+            (file for file in path.glob('*.npz') if not file.stem.endswith('.tmp')),
+            key=lambda file: file.stat().st_mtime
+        )
+        self.keys: t.List[str] = [file.stem for file in files]
+        self.evict()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+    def file(self, key: str) -> pathlib.Path:
+        return self.path / f'{key}.npz'
+
+    def add(self, key: str, columns: t.Mapping[str, np.ndarray]):
+        """
+        Save a city, replacing any city with the same key
+        :param key:
+        :param columns: the feature columns and the outcomes of everyone in the city
+        :return:
+        """
+        # write then rename, so a reader never sees half a file
+        temp_file = self.path / f'{key}.tmp.npz'
+        np.savez(temp_file, **columns)
+        os.replace(temp_file, self.file(key))
+        if key in self.keys:
+            self.keys.remove(key)
+        self.keys.append(key)
+        self.evict()
+
+    def load(self, key: str) -> t.Dict[str, np.ndarray]:
+        with np.load(self.file(key)) as data:
+            return dict(data)
+
+    def sample(self, rng: np.random.Generator, count: int,
+               exclude: t.Collection[str] = ()) -> t.List[t.Dict[str, np.ndarray]]:
+        """
+        Load some cities picked at random (without repeats if there are enough)
+        :param rng:
+        :param count: the number of cities
+        :param exclude: keys of cities not to pick (eg. the ones already in the minibatch)
+        :return:
+        """
+        keys = [key for key in self.keys if key not in exclude] if len(exclude) > 0 else self.keys
+        if count <= 0 or len(keys) == 0:
+            return []
+        picks = rng.choice(len(keys), size=count, replace=count > len(keys))
+        return [self.load(keys[pick]) for pick in picks.tolist()]
+
+    def evict(self):
+        """
+        Delete the oldest cities until there are at most max_cities
+        :return:
+        """
+        while len(self.keys) > self.max_cities:
+            self.file(self.keys.pop(0)).unlink(missing_ok=True)
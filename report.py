@@ -0,0 +1,94 @@
+from city import City
+from person import Person
+from population import Population, NO_DAY
+import typing as t
+import pathlib
+import csv
+import numpy as np
+
+
+def create_person_dictionary(p: Person):
+    return {
+        'vaccine_score': p.vaccine_score,
+        'is_heathcare': p.is_hospital_worker,
+        'is front line': p.is_frontline_worker,
+        'is teacher': p.is_teacher,
+        'age': p.age,
+        'household': p.household,
+        'female': p.sex_female,
+        'covid start date': p.covid_start_date,
+        'covid end date': p.covid_end_date,
+        'where they shop': p.shopping_id,
+        'work place': p.workplace_id,
+
+
+    }
+
+
+def create_person_table(c: City) -> t.Dict[str, np.ndarray]:
+    """
+    The same information as create_person_dictionary, for everyone at once, straight from the population's
+    arrays. Dates are datetime64 (NaT when not set) and 'where they shop' is a (pop, shops) boolean array
+    :param c:
+    :return: column name -> array (size: pop)
+    """
+    pop: Population = c.pop
+
+    def dates(days: np.ndarray) -> np.ndarray:
+        return np.where(days == NO_DAY, np.datetime64('NaT'), np.datetime64(pop.start_date) + days)
+
+    shopping = pop.shopping_matrix()
+    shopping[~pop.is_alive | pop.in_quarantine] = False
+    return {
+        'vaccine_score': pop.vaccine_score,
+        'is_heathcare': pop.is_hospital_worker,
+        'is front line': pop.is_frontline_worker,
+        'is teacher': pop.is_teacher,
+        'age': pop.age,
+        'household': pop.household,
+        'female': pop.sex_female,
+        'covid start date': dates(pop.covid_start),
+        'covid end date': dates(pop.covid_end),
+        'where they shop': shopping,
+        'work place': pop.workplace_id,
+    }
+
+
+def create_summary_dictionary(c: City):
+    res = {
+        'start_date': c.start_date.isoformat(),
+        'current_date': c.current_date.isoformat(),
+        'starting_pop': c.starting_population,
+        'current_pop': c.population,
+        'female_pop_pct': c.female_pct,
+        'male_pop_pct': 1-c.female_pct,
+        'sick': c.num_sick,
+        'recovered': c.num_recovered,
+        'uninfected': c.num_uninfected,
+        'dead': c.num_dead,
+        'vacinated': c.num_vaccinated,
+        'wasted_vaccine': c.num_wasted_vaccines,
+        'mortality_rate': c.num_dead / max(1, (c.num_dead + c.num_recovered)),
+        'infection_rate': (c.num_recovered + c.num_dead + c.num_sick) / max(1, c.starting_population),
+        'teacher_sick_rate': c.teachers_pct_sick,
+        'hospital_worker_sick_rate': c.hospital_worker_pct_sick,
+        'frontline_worker_sick_rate': c.frontline_worker_pct_sick
+    }
+    return res
+
+
+def write_csv(csv_file_path: pathlib.Path, rows: t.Iterable[t.Dict]):
+    """
+    Write rows (eg. from create_summary_dictionary or create_person_dictionary) to a csv file. The header comes
+    from the keys of the first row
+    :param csv_file_path:
+    :param rows:
+    :return:
+    """
+    with csv_file_path.open('w', newline='') as csv_file:
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(csv_file, fieldnames=list(row.keys()))
+                writer.writeheader()
+            writer.writerow(row)
@@ -0,0 +1,239 @@
+from city import City
+from vaccine import VaccineBase
+from report import create_summary_dictionary, write_csv
+from sinks import make_sink
+from metrics import CityMetrics
+from checkpoint import save_city, load_city
+from city_cache import CityCache
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import dataclasses
+import typing as t
+import pathlib
+import sys
+import time
+import zlib
+import numpy as np
+
+
+@dataclasses.dataclass(frozen=True)
+class CityConfig:
+    """
+    How to build a city for a trial
+    """
+    name: str
+    size: int = 1000
+    initial_sick: int = 100
+    vectorized: bool = False
+    event_driven: bool = True     # skip the work on days when nothing can happen (same results)
+
+
+@dataclasses.dataclass
+class TrialJob:
+    """
+    One trial: a vaccine strategy run on one city for a number of days
+    """
+    vaccine: VaccineBase
+    city: CityConfig
+    trial_num: int
+    days: int
+    seed: int
+    output_dir: t.Optional[pathlib.Path] = None      # where the worker writes the results (None to not write any)
+    output_format: str = 'csv'                       # see sinks.SINKS
+    checkpoint_dir: t.Optional[pathlib.Path] = None  # where the worker saves the city while it runs (None to not)
+    checkpoint_every: int = 30                       # days between checkpoints
+    city_cache: t.Optional[CityCache] = None        # where the worker loads (or saves) the built city
+    measure: bool = False                            # time each phase of each day (see CityMetrics)
+
+    @property
+    def checkpoint(self) -> t.Optional[pathlib.Path]:
+        if self.checkpoint_dir is None:
+            return None
+        return self.checkpoint_dir / f'{self.city.name}-{self.vaccine.name}-{self.trial_num}-{self.seed}.npz'
+
+
+@dataclasses.dataclass
+class TrialResult:
+    job: TrialJob
+    summary: t.List[t.Dict]     # create_summary_dictionary for each day
+    run_time: float             # seconds
+    metrics: t.Optional[t.Dict[str, float]] = None     # seconds spent in each phase, if the trial was measured
+
+
+def trial_seed(base_seed: int, config: CityConfig, trial_num: int) -> int:
+    """
+    The seed for a trial. It depends on the city and the trial number but not on the vaccine, so every
+    strategy is run on the same city with the same random numbers
+    :param base_seed: seed for the whole set of trials
+    :param config:
+    :param trial_num:
+    :return:
+    """
+    entropy = [base_seed, zlib.crc32(config.name.encode()), config.size, config.initial_sick, trial_num]
+    return int(np.random.SeedSequence(entropy).generate_state(1, dtype=np.uint64)[0])
+
+
+def simulate(city: City, days: int, progress: bool = False, checkpoint: t.Optional[pathlib.Path] = None,
+             checkpoint_every: int = 30) -> t.Iterator[t.Dict]:
+    """
+    Run the simulation, giving the summary of the city on each day (starting with the initial state)
+    :param city:
+    :param days: number of days, including the first
+    :param progress: print a dot every 30 days
+    :param checkpoint: a file to save the city and the summaries to every checkpoint_every days (see
+        checkpoint.save_city). If the file is already there, the run carries on from it instead of starting over
+        (the summaries saved with it are given first), with the same results as if it had never stopped. A file
+        saved from a different run (another seed, initial sick or number of days) is ignored, and overwritten
+    :param checkpoint_every: days between checkpoints
+    :return:
+    """
+    if checkpoint is not None and city.seed is None:
+        raise ValueError(f"Can't checkpoint {city.name}: only a seeded city can be made the same way again")
+    summaries = []
+    if checkpoint is not None and checkpoint.exists():
+        try:
+            summaries = load_city(checkpoint, city, days)
+        except ValueError as error:
+            print(f'Starting {city.name} over: {error}', file=sys.stderr)
+    if len(summaries) > 0:
+        yield from summaries
+    else:
+        with city.measure('summary'):
+            summary = create_summary_dictionary(city)
+        summaries.append(summary)
+        yield summary
+    for tick in range(len(summaries), days):
+        if progress and tick % 30 == 0:
+            print('.', end='', flush=True)
+        city.run_timestep()
+        with city.measure('summary'):
+            summary = create_summary_dictionary(city)
+        summaries.append(summary)
+        if checkpoint is not None and tick % checkpoint_every == 0:
+            save_city(checkpoint, city, days, summaries)
+        yield summary
+
+
+def run_job(job: TrialJob) -> TrialResult:
+    """
+    Build the city for a trial, run it and write its results. This is what each worker process does
+    :param job:
+    :return:
+    """
+    start_time = time.perf_counter()
+    city = City(
+        name=job.city.name,
+        size=job.city.size,
+        initial_sick=job.city.initial_sick,
+        vectorized=job.city.vectorized,
+        event_driven=job.city.event_driven,
+        seed=job.seed,
+        cache=job.city_cache
+    )
+    if job.measure:
+        city.metrics = CityMetrics()
+    job.vaccine.assign_scores(city)
+    if job.checkpoint is not None:
+        job.checkpoint.parent.mkdir(parents=True, exist_ok=True)
+    summary = list(simulate(city, job.days, checkpoint=job.checkpoint, checkpoint_every=job.checkpoint_every))
+    if job.output_dir is not None:
+        with make_sink(job.output_format, job.output_dir, city.name, job.vaccine.name, job.trial_num) as sink:
+            with city.measure('write_summary'):
+                for row in summary:
+                    sink.add_summary(row)
+            with city.measure('write_person_info'):
+                sink.add_people(city)
+    if job.checkpoint is not None:
+        # the trial is done, a rerun should start it again
+        job.checkpoint.unlink(missing_ok=True)
+    if job.measure and job.output_dir is not None:
+        write_csv(job.output_dir / f'{city.name}-{job.vaccine.name}-metrics-{job.trial_num}.csv', city.metrics.table())
+    return TrialResult(job=job, summary=summary, run_time=time.perf_counter() - start_time,
+                       metrics=dict(city.metrics.totals) if job.measure else None)
+
+
+class TrialAggregator:
+    """
+    Receives the results of the trials as they finish (in any order) and keeps the final summary of every trial.
+    (The workers write the full results of each trial themselves, see TrialJob.output_dir)
+    """
+    def __init__(self):
+        self.final: t.List[t.Dict] = []     # last summary of each trial, with the trial details
+
+    def add(self, result: TrialResult):
+        job = result.job
+        self.final.append({
+            'city': job.city.name,
+            'vaccine': job.vaccine.name,
+            'trial': job.trial_num,
+            'seed': job.seed,
+            **result.summary[-1],
+        })
+        print(f"\tCompleted trial {job.city.name} - {job.vaccine.name} #{job.trial_num}: {result.run_time:0.2f} sec")
+        if result.metrics is not None:
+            # How long each phase took, in total
+            print('\t\t' + ', '.join(f'{phase}: {seconds:0.2f} sec' for phase, seconds in result.metrics.items()))
+
+
+def init_worker():
+    # Each process runs one trial at a time, so don't let torch start a thread per core in every process
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(1)
+
+
+def run_trials(vaccines: t.Sequence[VaccineBase], cities: t.Sequence[CityConfig], trials: int, days: int,
+               base_seed: int = 0, workers: t.Optional[int] = None, aggregator: t.Optional[TrialAggregator] = None,
+               output_dir: t.Optional[pathlib.Path] = None, output_format: str = 'csv',
+               checkpoint_dir: t.Optional[pathlib.Path] = None, checkpoint_every: int = 30,
+               city_cache: t.Optional[CityCache] = None, measure: bool = False) -> TrialAggregator:
+    """
+    Run every (city, trial number, vaccine) combination, spread over a pool of processes. Each trial builds its
+    own city from its own seed, so the results are the same however many workers are used
+    :param vaccines: the strategies to compare
+    :param cities: the cities to run them on
+    :param trials: number of trials for each city
+    :param days: number of days in each trial
+    :param base_seed: seed for the whole set of trials
+    :param workers: number of processes (None for one per core, 1 to run in this process)
+    :param aggregator: receives each result as it finishes
+    :param output_dir: where to write the results of each trial (None to not write any)
+    :param output_format: how to write them, see sinks.SINKS
+    :param checkpoint_dir: where to save each running trial every checkpoint_every days (None to not). Trials
+        that were stopped part way carry on from their checkpoint when they are run again
+    :param checkpoint_every: days between checkpoints
+    :param city_cache: where to keep each trial's city once it is built (None to not). Every vaccine is run on the
+        same city, so it is only built once (the trial's other vaccines wait for the first one to build it), and
+        later runs don't build it at all
+    :param measure: time each phase of every trial's days (see CityMetrics). The totals are printed as each trial
+        finishes, and the daily rows are written to a -metrics- csv file next to its results
+    :return: the aggregator
+    """
+    aggregator = aggregator if aggregator is not None else TrialAggregator()
+    jobs = [
+        TrialJob(vaccine=vaccine, city=config, trial_num=trial_num, days=days,
+                 seed=trial_seed(base_seed, config, trial_num), output_dir=output_dir, output_format=output_format,
+                 checkpoint_dir=checkpoint_dir, checkpoint_every=checkpoint_every, city_cache=city_cache,
+                 measure=measure)
+        for config in cities
+        for trial_num in range(trials)
+        for vaccine in vaccines
+    ]
+    if workers == 1:
+        for job in jobs:
+            aggregator.add(run_job(job))
+    else:
+        if city_cache is None:
+            waiting = [[job] for job in jobs]
+        else:
+            # the first job of each trial builds its city into the cache, and the trial's other jobs only start once
+            # it is done, so they load the city instead of all building it at the same time
+            waiting = [jobs[start:start + len(vaccines)] for start in range(0, len(jobs), max(len(vaccines), 1))]
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            # future -> the jobs to start once it is done
+            running = {pool.submit(run_job, first): rest for first, *rest in waiting}
+            while len(running) > 0:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for job in running.pop(future):
+                        running[pool.submit(run_job, job)] = []
+                    aggregator.add(future.result())
+    return aggregator
@@ -0,0 +1,365 @@
+from city import City
+from population import Population, NO_DAY
+from vaccine import VaccineBase
+from runner import CityConfig
+from chance import AGE_BRACKETS, AGE_FACTORS, PREEXISTING_CONDITION_FACTOR
+from datetime import date, timedelta
+import dataclasses
+import itertools
+import typing as t
+import numpy as np
+
+from settings import *
+
+
+# The disease parameters a scenario can change. Their defaults are the settings of the same name (in upper case)
+PARAMETERS = (
+    'recovery_rate_stage_0',
+    'recovery_rate_stage_1',
+    'recovery_rate_stage_2',
+    'recovery_rate_stage_3',
+    'chance_of_getting_sick_from_interaction',
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class Scenario:
+    """
+    A vaccine strategy and a set of disease parameters to run a city with
+    """
+    vaccine: VaccineBase
+    trial: int = 0      # scenarios that only differ by trial get different random draws
+    recovery_rate_stage_0: float = RECOVERY_RATE_STAGE_0
+    recovery_rate_stage_1: float = RECOVERY_RATE_STAGE_1
+    recovery_rate_stage_2: float = RECOVERY_RATE_STAGE_2
+    recovery_rate_stage_3: float = RECOVERY_RATE_STAGE_3
+    chance_of_getting_sick_from_interaction: float = CHANGE_OF_GETTING_SICK_FROM_INTERACTION
+
+    @property
+    def recovery_rates(self) -> t.Tuple[float, float, float, float]:
+        return (self.recovery_rate_stage_0, self.recovery_rate_stage_1, self.recovery_rate_stage_2,
+                self.recovery_rate_stage_3)
+
+
+def scenario_grid(vaccines: t.Sequence[VaccineBase], trials: int = 1,
+                  **parameters: t.Sequence[float]) -> t.List[Scenario]:
+    """
+    Every combination of vaccines, trials and parameter values, eg.
+    scenario_grid([NoVaccine('none')], trials=5, recovery_rate_stage_0=[0.4, 0.5, 0.6])
+    :param vaccines: the strategies
+    :param trials: the number of trials of each combination
+    :param parameters: name (see PARAMETERS) -> the values to try. The other parameters keep their defaults
+    :return:
+    """
+    unknown = set(parameters) - set(PARAMETERS)
+    if unknown:
+        raise ValueError(f'Unknown parameters {sorted(unknown)}, they can be {PARAMETERS}')
+    names = list(parameters)
+    return [
+        Scenario(vaccine=vaccine, trial=trial, **dict(zip(names, values)))
+        for vaccine in vaccines
+        for values in itertools.product(*(parameters[name] for name in names))
+        for trial in range(trials)
+    ]
+
+
+class LaneSimulation:
+    """
+    Runs a vectorized city under many scenarios at once. Each scenario is a lane: the state columns of the population
+    are stacked into (pop, lanes) arrays, while the demographics and the location memberships are shared by every
+    lane. A day is counted for all the lanes together: the interactions with sparse matrix products over the
+    (pop, lanes) matrix of who is sick, and the infections and stage changes over whole arrays.
+
+    Same rules as City.run_timestep in vectorized mode, with each lane's disease parameters instead of the settings.
+    The random draws are made in a different order, so the results are statistically the same rather than identical.
+    Only what goes into the summary (see summary) is kept for each lane, not visible_symptoms or vaccine_day
+    """
+    STATE_COLUMNS = (
+        'covid_immunity', 'covid_start', 'covid_end', 'sickness_level', 'is_alive', 'in_quarantine',
+        'is_vaccinated', 'vaccine_wasted'
+    )
+
+    def __init__(self, city: City, scenarios: t.Sequence[Scenario], vaccine_scores: t.Mapping[str, np.ndarray],
+                 rng: np.random.Generator):
+        """
+        :param city: a city that hasn't been run yet, each lane starts from its state
+        :param scenarios: one for each lane
+        :param vaccine_scores: vaccine name -> the scores the vaccine gives everyone in the city
+        :param rng: random number generator for all the lanes
+        """
+        pop: Population = city.pop
+        self.pop = pop
+        self.contacts = city.contacts
+        self.scenarios = list(scenarios)
+        self.rng = rng
+        self.start_date = city.start_date
+        self.current_date = city.current_date
+        self.vaccine_doses = dict(city.vaccine_doses)
+        lanes = len(self.scenarios)
+        for name in self.STATE_COLUMNS:
+            setattr(self, name, np.repeat(getattr(pop, name)[:, np.newaxis], lanes, axis=1))
+
+        # Each lane's parameters
+        self.recovery_rates = np.array([scenario.recovery_rates for scenario in self.scenarios]).reshape(lanes, 4)
+        self.log_chance = np.log1p([scenario.chance_of_getting_sick_from_interaction for scenario in self.scenarios])
+
+        # Each vaccine's order (see City.set_vaccine_order), and where each lane is up to in its vaccine's order
+        vaccines = sorted({scenario.vaccine.name for scenario in self.scenarios})
+        self.vaccine_scores = [vaccine_scores[name] for name in vaccines]
+        self.vaccine_orders = [np.argsort(scores, kind='stable') for scores in self.vaccine_scores]
+        self.lane_vaccine = np.array([vaccines.index(scenario.vaccine.name) for scenario in self.scenarios], dtype=int)
+        self.vaccine_cursor = np.zeros(lanes, dtype=np.int64)
+
+        # How much more likely each person is to catch covid (see ChanceTable) and to not recover (see advance)
+        risk_group = np.searchsorted(AGE_BRACKETS, pop.age, side='right')
+        self.risk = np.take(AGE_FACTORS, risk_group) * np.where(pop.preexisting_condition,
+                                                                PREEXISTING_CONDITION_FACTOR, 1.0)
+        self.health_factor = np.where(pop.preexisting_condition, 1.5, 1.0) * np.where(pop.age >= 65, 1.5, 1.0)
+
+        # The initially sick were infected before the start date, and the city has already moved them through the
+        # days since with the default recovery rates (see Population.fast_forward). Lanes with other rates go
+        # through those days again with their own
+        default_rates = (RECOVERY_RATE_STAGE_0, RECOVERY_RATE_STAGE_1, RECOVERY_RATE_STAGE_2, RECOVERY_RATE_STAGE_3)
+        redo = np.flatnonzero((self.recovery_rates != default_rates).any(axis=1))
+        self.fast_forward(np.flatnonzero(pop.initially_sick), redo)
+
+        # Who is in which group, for the sick rates in the summary
+        adult = pop.age >= 18
+        self.groups = {group: adult & (pop.work == work_id)
+                       for group, work_id in (('teacher', SCHOOL_ID), ('hospital_worker', HOSPITAL_ID),
+                                              ('frontline_worker', FRONTLINE_ID))}
+
+    def __len__(self) -> int:
+        return len(self.scenarios)
+
+    def fast_forward(self, people: np.ndarray, lanes: np.ndarray):
+        """
+        Put people back to the day they were infected in some lanes, then apply all the stages of the disease they
+        have been through before the start date with the lanes' recovery rates. Matches Population.fast_forward
+        :param people: index of the people (infected before the start date, and not vaccinated)
+        :param lanes: the lanes to do it in
+        :return:
+        """
+        if len(people) == 0 or len(lanes) == 0:
+            return
+        rows, columns = people[:, np.newaxis], lanes[np.newaxis, :]
+        self.covid_end[rows, columns] = NO_DAY
+        self.covid_immunity[rows, columns] = 0.0
+        self.sickness_level[rows, columns] = 0
+        self.is_alive[rows, columns] = True
+        self.in_quarantine[rows, columns] = False
+
+        sick = (rows * len(self) + columns).ravel()
+        for stage_day in Population.STAGE_DAYS:
+            still_sick = sick[self.is_alive.ravel()[sick] & (self.covid_end.ravel()[sick] == NO_DAY)]
+            reached = still_sick[self.covid_start.ravel()[still_sick] + stage_day < 0]
+            self.advance(reached, stage_day, self.covid_start.ravel()[reached] + stage_day)
+
+    @property
+    def current_day(self) -> int:
+        return (self.current_date - self.start_date).days
+
+    def run_timestep(self) -> date:
+        """
+        Timestep to update every lane. See City.run_timestep
+        :return:
+        """
+        interactions = self.interactions()
+        self.step4_vaccine()
+        self.step5_health_update(interactions)
+        self.current_date += timedelta(days=1)
+        return self.current_date
+
+    def interactions(self) -> np.ndarray:
+        """
+        Count the interactions everyone has with sick people today, in each lane. Matches ContactNetwork.interactions
+        :return: a (pop, lanes) array
+        """
+        pop, contacts = self.pop, self.contacts
+        contagious = self.is_alive & (self.covid_start != NO_DAY)
+        if not RECOVERED_ARE_CONTAGIOUS:
+            contagious &= self.covid_end == NO_DAY
+        if not contagious.any():
+            return np.zeros(contagious.shape, dtype=np.int64)
+        sick = contagious.astype(np.int64)
+
+        # Step 1: sick people in quarantine meet everyone at their (usual) workplace
+        work_sick = contacts.work_t @ (contagious & self.in_quarantine).astype(np.int64)
+        interactions = WORK_INTERACTIONS * (contacts.work @ work_sick)
+
+        # Step 2: sick people meet everyone in their household
+        interactions += HOME_INTERACTIONS * (contacts.households @ (contacts.households_t @ sick))
+
+        # Step 3: sick people visit their shops and the shop matching their workplace id (once if it is both)
+        shopping_sick = contacts.shopping_t @ sick
+        people, lanes = np.nonzero(contagious)
+        workplace = np.where(self.sickness_level[people, lanes] == 3, HOSPITAL_ID, pop.work[people])
+        is_shop = (workplace >= 0) & (workplace <= MAX_SHOP_ID)
+        lanes, people, workplace = lanes[is_shop], people[is_shop], workplace[is_shop]
+        visits_workplace = (pop.shopping[people] >> workplace.astype(np.uint32)) & 1 == 0
+        np.add.at(shopping_sick, (workplace[visits_workplace], lanes[visits_workplace]), 1)
+        interactions += SHOPPING_INTERACTIONS * (contacts.shopping @ shopping_sick)
+
+        # Only vulnerable people pick up interactions
+        interactions[~self.is_alive | (self.covid_start != NO_DAY)] = 0
+        return interactions
+
+    def step4_vaccine(self):
+        """
+        Apply the vaccine in each lane. Matches City.step4_vaccine
+        :return:
+        """
+        doses = self.vaccine_doses.get(self.current_date, 0)
+        if doses <= 0:
+            return
+        for lane in range(len(self)):
+            order = self.vaccine_orders[self.lane_vaccine[lane]]
+            scores = self.vaccine_scores[self.lane_vaccine[lane]]
+            is_alive, is_vaccinated = self.is_alive[:, lane], self.is_vaccinated[:, lane]
+            vaccines_available = doses
+            cursor = int(self.vaccine_cursor[lane])
+            chosen = []
+            while vaccines_available > 0 and cursor < len(order):
+                window = order[cursor:cursor + max(2 * vaccines_available, 1024)]
+                eligible = is_alive[window] & ~is_vaccinated[window] & (scores[window] >= 0)
+                given = np.flatnonzero(eligible)[:vaccines_available]
+                chosen.append(window[given])
+                vaccines_available -= len(given)
+                cursor += int(given[-1]) + 1 if vaccines_available == 0 else len(window)
+            self.vaccine_cursor[lane] = cursor
+            if len(chosen) > 0:
+                people = np.concatenate(chosen)
+                is_vaccinated[people] = True
+                self.covid_immunity[people, lane] = 1.0
+                self.vaccine_wasted[people, lane] = (self.covid_start[people, lane] != NO_DAY) & is_alive[people]
+
+    def step5_health_update(self, interactions: np.ndarray):
+        """
+        Update everyone's health in each lane. Matches City.step5_health_update_batched
+        :param interactions: from interactions()
+        :return:
+        """
+        day = self.current_day
+
+        # Only people with interactions can catch covid. People are found by their index in the flattened
+        # (pop, lanes) arrays: person * lanes + lane
+        exposed = np.flatnonzero(interactions > 0)
+        people, lanes = np.divmod(exposed, len(self))
+        probability = (np.expm1(interactions.ravel()[exposed] * self.log_chance[lanes]) * self.risk[people]
+                       * (1 - self.covid_immunity.ravel()[exposed]))
+        infected = exposed[self.rng.random(len(exposed)) < probability]
+
+        # update the health of the people already sick (the newly infected have nothing happen on their first day)
+        sick = np.flatnonzero(self.is_alive & (self.covid_start != NO_DAY) & (self.covid_end == NO_DAY))
+        days_since_infection = day - self.covid_start.ravel()[sick]
+        for stage_day in Population.STAGE_DAYS:
+            self.advance(sick[days_since_infection == stage_day], stage_day, day)
+        self.covid_start.ravel()[infected] = day
+
+    def advance(self, sick: np.ndarray, stage_day: int, day: t.Union[int, np.ndarray]):
+        """
+        Apply the change in health that happens a number of days after infection. Matches Population.advance
+        :param sick: the people who have been sick for stage_day days, by their index in the flattened (pop, lanes)
+            arrays
+        :param stage_day: one of Population.STAGE_DAYS
+        :param day: the day offset it happens on (the same for everyone or one per person)
+        :return:
+        """
+        if len(sick) == 0:
+            return
+        if stage_day == 3:
+            self.sickness_level.ravel()[sick] = 0
+            return
+        if stage_day == 5:
+            return
+
+        # Recover (or else get worse)
+        stage = Population.STAGE_DAYS.index(stage_day) - 2
+        people, lanes = np.divmod(sick, len(self))
+        recovered = self.rng.random(len(sick)) * self.health_factor[people] < self.recovery_rates[lanes, stage]
+        day = np.broadcast_to(day, sick.shape)
+        better = sick[recovered]
+        self.covid_end.ravel()[better] = day[recovered]
+        self.covid_immunity.ravel()[better] = 1.0
+        self.in_quarantine.ravel()[better] = False
+
+        worse = sick[~recovered]
+        if stage < 3:
+            self.sickness_level.ravel()[worse] = stage + 1
+            if stage == 0:
+                self.in_quarantine.ravel()[worse] = True
+        else:
+            self.is_alive.ravel()[worse] = False
+            self.covid_end.ravel()[worse] = day[~recovered]
+
+    def summary(self) -> t.Dict[str, np.ndarray]:
+        """
+        The numbers from create_summary_dictionary, for each lane
+        :return: name -> an array (size: lanes)
+        """
+        was_sick = self.covid_start != NO_DAY
+        has_ended = self.covid_end != NO_DAY
+        sick = np.count_nonzero(self.is_alive & was_sick & ~has_ended, axis=0)
+        recovered = np.count_nonzero(self.is_alive & was_sick & has_ended, axis=0)
+        dead = np.count_nonzero(~self.is_alive, axis=0)
+        starting_pop = len(self.pop)
+        summary = {
+            'current_date': np.full(len(self), self.current_date.isoformat()),
+            'sick': sick,
+            'recovered': recovered,
+            'uninfected': np.count_nonzero(self.is_alive & ~was_sick, axis=0),
+            'dead': dead,
+            'vacinated': np.count_nonzero(self.is_vaccinated, axis=0),
+            'wasted_vaccine': np.count_nonzero(self.vaccine_wasted, axis=0),
+            'mortality_rate': dead / np.maximum(1, dead + recovered),
+            'infection_rate': (recovered + dead + sick) / max(1, starting_pop),
+        }
+        for group, members in self.groups.items():
+            sick_members = np.count_nonzero(was_sick & members[:, np.newaxis], axis=0)
+            summary[f'{group}_sick_rate'] = sick_members / max(1, np.count_nonzero(members))
+        return summary
+
+
+def run_scenarios(config: CityConfig, scenarios: t.Sequence[Scenario], days: int, seed: int = 0,
+                  lanes: int = 64) -> t.Dict[str, np.ndarray]:
+    """
+    Run a city under every scenario, a batch of lanes at a time (see LaneSimulation). Every scenario starts from the
+    same city, built from the seed
+    :param config: the city (it is always run vectorized)
+    :param scenarios: eg. from scenario_grid
+    :param days: number of days, including the first (see runner.simulate)
+    :param seed: seed for the city and the random draws. The results are repeatable for the same number of lanes
+    :param lanes: the number of scenarios run at once (each lane holds about 15 bytes a person)
+    :return: a tidy table, column name -> array, with one row for each scenario on each day. The columns are the
+        scenario's index, vaccine, trial and parameters followed by the numbers from LaneSimulation.summary
+    """
+    city = City(name=config.name, size=config.size, initial_sick=config.initial_sick, vectorized=True, seed=seed)
+    vaccine_scores = {}
+    for vaccine in {scenario.vaccine.name: scenario.vaccine for scenario in scenarios}.values():
+        scored = city.clone()
+        vaccine.assign_scores(scored)
+        vaccine_scores[vaccine.name] = scored.pop.vaccine_score.copy()
+
+    batch_seeds = np.random.SeedSequence(seed).spawn((len(scenarios) + lanes - 1) // lanes)
+    columns: t.Dict[str, t.List[np.ndarray]] = {}
+    for batch, batch_seed in enumerate(batch_seeds):
+        first = batch * lanes
+        batch_scenarios = scenarios[first:first + lanes]
+        simulation = LaneSimulation(city, batch_scenarios, vaccine_scores, np.random.default_rng(batch_seed))
+        scenario_info = {
+            'scenario': np.arange(first, first + len(batch_scenarios)),
+            'vaccine': np.array([scenario.vaccine.name for scenario in batch_scenarios]),
+            'trial': np.array([scenario.trial for scenario in batch_scenarios]),
+            **{name: np.array([getattr(scenario, name) for scenario in batch_scenarios]) for name in PARAMETERS},
+        }
+        summaries = [simulation.summary()]
+        for _ in range(1, days):
+            simulation.run_timestep()
+            summaries.append(simulation.summary())
+
+        # one row for each scenario on each day, sorted by scenario then day
+        for name, values in scenario_info.items():
+            columns.setdefault(name, []).append(np.repeat(values, len(summaries)))
+        for name in summaries[0]:
+            columns.setdefault(name, []).append(np.stack([summary[name] for summary in summaries], axis=1).ravel())
+    return {name: np.concatenate(parts) for name, parts in columns.items()}
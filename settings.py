@@ -8,6 +8,11 @@ RECOVERY_RATE_STAGE_2 = 0.5                           # Base chance of recoverin
 RECOVERY_RATE_STAGE_3 = 0.9                           # Base chance of recovering from stage 3 (else you die)
 
 CHANGE_OF_GETTING_SICK_FROM_INTERACTION = 0.0000025    # Chance of getting sick from a single interaction)
+RECOVERED_ARE_CONTAGIOUS = False                       # True to keep spreading covid after recovering (old behaviour)
+
+WORK_INTERACTIONS = 10                                 # Interactions with each sick co-worker in a day
+HOME_INTERACTIONS = 40                                 # Interactions with each sick person in the household in a day
+SHOPPING_INTERACTIONS = 5                              # Interactions with each sick person at a shop in a day
 
 
 # Constants
@@ -15,7 +20,16 @@ SCHOOL_ID = 0
 HOSPITAL_ID = 1
 FRONTLINE_ID = 2
 NO_WORK_ID = -1
+MAX_WORK_ID = 20                                       # workplaces are numbered [NO_WORK_ID, MAX_WORK_ID]
+MAX_SHOP_ID = 20                                       # shopping places are numbered [0, MAX_SHOP_ID]
 
 
 # Other settings
 output_dir = pathlib.Path(r'./output')
+output_format = 'csv'                                   # how trial results are written: 'csv', 'npz' or 'parquet'
+checkpoint_dir = output_dir / 'checkpoints'             # where running trials and training are saved to resume from
+checkpoint_every = 30                                   # days (or training cycles) between checkpoints
+city_cache_dir = output_dir / 'city_cache'              # where built cities are kept to load again (see CityCache)
+city_cache_bytes = 10 * 2 ** 30                         # the most disk space the city cache can use
+inference_batch_size = 2 ** 16                          # people the AI scores at a time (see get_prediction)
+inference_threads = 4                                   # the most threads torch uses to score people
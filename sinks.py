@@ -0,0 +1,191 @@
+from city import City
+from report import create_person_dictionary, create_person_table
+import typing as t
+import pathlib
+import csv
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class ResultsSink:
+    """
+    Where the results of one trial go: a summary row for each day (see create_summary_dictionary) and a table
+    with everyone in the city at the end. Use as a context manager, or call close() when done
+    """
+    extension = ''
+
+    def __init__(self, output_dir: pathlib.Path, city_name: str, vaccine_name: str, trial_num: int):
+        output_dir.mkdir(parents=True, exist_ok=True)
+        self.summary_path = output_dir / f'{city_name}-{vaccine_name}-{trial_num}.{self.extension}'
+        self.person_info_path = output_dir / f'{city_name}-{vaccine_name}-person_info-{trial_num}.{self.extension}'
+
+    def __enter__(self) -> 'ResultsSink':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_summary(self, row: t.Dict):
+        raise NotImplementedError()
+
+    def add_people(self, city: City):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class CsvSink(ResultsSink):
+    """
+    The original csv files, one row at a time
+    """
+    extension = 'csv'
+
+    def __init__(self, output_dir: pathlib.Path, city_name: str, vaccine_name: str, trial_num: int):
+        super().__init__(output_dir, city_name, vaccine_name, trial_num)
+        self.summary_file: t.Optional[t.TextIO] = None
+        self.summary_writer: t.Optional[csv.DictWriter] = None
+
+    def add_summary(self, row: t.Dict):
+        if self.summary_writer is None:
+            self.summary_file = self.summary_path.open('w', newline='')
+            self.summary_writer = csv.DictWriter(self.summary_file, fieldnames=list(row.keys()))
+            self.summary_writer.writeheader()
+        self.summary_writer.writerow(row)
+
+    def add_people(self, city: City):
+        with self.person_info_path.open('w', newline='') as csv_file:
+            writer = None
+            for person in city.pop:
+                person_info = create_person_dictionary(person)
+                if writer is None:
+                    writer = csv.DictWriter(csv_file, fieldnames=list(person_info.keys()))
+                    writer.writeheader()
+                writer.writerow(person_info)
+
+    def close(self):
+        if self.summary_file is not None:
+            self.summary_file.close()
+            self.summary_file = None
+
+
+class ColumnarSink(ResultsSink):
+    """
+    Buffers the daily summaries and hands them over in blocks of columns (one array per summary field).
+    Dates are stored as datetime64
+    """
+    def __init__(self, output_dir: pathlib.Path, city_name: str, vaccine_name: str, trial_num: int,
+                 block_size: int = 1024):
+        super().__init__(output_dir, city_name, vaccine_name, trial_num)
+        self.block_size = block_size
+        self.buffer: t.List[t.Dict] = []
+
+    def add_summary(self, row: t.Dict):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        block = {}
+        for name in self.buffer[0]:
+            column = np.asarray([row[name] for row in self.buffer])
+            if column.dtype.kind == 'U':
+                column = column.astype('datetime64[D]')
+            block[name] = column
+        self.buffer = []
+        self.write_block(block)
+
+    def write_block(self, block: t.Dict[str, np.ndarray]):
+        raise NotImplementedError()
+
+    def close(self):
+        self.flush()
+
+
+class NpzSink(ColumnarSink):
+    """
+    NumPy .npz files: one array per column. The summary blocks are kept (as arrays) until the sink is closed
+    """
+    extension = 'npz'
+
+    def __init__(self, output_dir: pathlib.Path, city_name: str, vaccine_name: str, trial_num: int,
+                 block_size: int = 1024):
+        super().__init__(output_dir, city_name, vaccine_name, trial_num, block_size)
+        self.blocks: t.List[t.Dict[str, np.ndarray]] = []
+
+    def write_block(self, block: t.Dict[str, np.ndarray]):
+        self.blocks.append(block)
+
+    def add_people(self, city: City):
+        np.savez(self.person_info_path, **create_person_table(city))
+
+    def close(self):
+        super().close()
+        if len(self.blocks) > 0:
+            np.savez(self.summary_path, **{
+                name: np.concatenate([block[name] for block in self.blocks]) for name in self.blocks[0]
+            })
+            self.blocks = []
+
+
+class ParquetSink(ColumnarSink):
+    """
+    Parquet files (needs pyarrow). Each block of summaries is written as it is flushed, as one row group.
+    Where people shop is stored as a bitmask (bit n set if they shop at shop n)
+    """
+    extension = 'parquet'
+
+    def __init__(self, output_dir: pathlib.Path, city_name: str, vaccine_name: str, trial_num: int,
+                 block_size: int = 1024):
+        if pyarrow is None:
+            raise ImportError('pyarrow is needed to write parquet files')
+        super().__init__(output_dir, city_name, vaccine_name, trial_num, block_size)
+        self.writer: t.Optional['pyarrow.parquet.ParquetWriter'] = None
+
+    def write_block(self, block: t.Dict[str, np.ndarray]):
+        table = pyarrow.table(block)
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.summary_path, table.schema)
+        self.writer.write_table(table)
+
+    def add_people(self, city: City):
+        table = create_person_table(city)
+        shop_bits = np.uint64(1) << np.arange(table['where they shop'].shape[1], dtype=np.uint64)
+        table['where they shop'] = (table['where they shop'] * shop_bits).sum(axis=1, dtype=np.uint64)
+        pyarrow.parquet.write_table(pyarrow.table(table), self.person_info_path)
+
+    def close(self):
+        super().close()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+SINKS: t.Dict[str, t.Type[ResultsSink]] = {
+    'csv': CsvSink,
+    'npz': NpzSink,
+    'parquet': ParquetSink,
+}
+
+
+def make_sink(output_format: str, output_dir: pathlib.Path, city_name: str, vaccine_name: str,
+              trial_num: int) -> ResultsSink:
+    """
+    Make a results sink by name
+    :param output_format: one of SINKS ('csv', 'npz' or 'parquet')
+    :param output_dir:
+    :param city_name:
+    :param vaccine_name:
+    :param trial_num:
+    :return:
+    """
+    if output_format not in SINKS:
+        raise ValueError(f'Unknown output format {output_format!r}, expected one of {list(SINKS)}')
+    return SINKS[output_format](output_dir, city_name, vaccine_name, trial_num)
@@ -0,0 +1,117 @@
+from population import Population, NO_DAY
+import typing as t
+import copy
+import numpy as np
+
+from settings import *
+
+
+class CityStats:
+    """
+    Running totals of the counts reported about a city every day (number sick, recovered, dead, ...).
+
+    The totals are kept up to date by the Population actions (infect, recover, kill, vaccinate): the
+    people being changed are taken out of the totals before the change and added back in after, so
+    reading a count never needs a scan of the whole population. In debug mode every read is checked
+    against a full scan.
+    """
+    COUNTERS = (
+        'alive',
+        'sick',
+        'recovered',
+        'uninfected',
+        'vaccinated',
+        'wasted_vaccines',
+        'teachers_sick',
+        'hospital_workers_sick',
+        'frontline_workers_sick',
+    )
+
+    def __init__(self, pop: Population, debug: bool = False):
+        self.pop = pop
+        self.debug = debug
+
+        # These never change during a simulation
+        self.starting_population = len(pop)
+        self.female = int(np.count_nonzero(pop.sex_female))
+        self.teachers = int(np.count_nonzero(pop.is_teacher))
+        self.hospital_workers = int(np.count_nonzero(pop.is_hospital_worker))
+        self.frontline_workers = int(np.count_nonzero(pop.is_frontline_worker))
+
+        self.counts: np.ndarray = self.tally(pop)
+        pop.observers.append(self)
+
+    def reset(self):
+        """
+        Recount everything with a full scan (eg. after the population's state was replaced)
+        :return:
+        """
+        self.counts = self.tally(self.pop)
+
+    def clone(self, pop: Population) -> 'CityStats':
+        """
+        Copy the statistics for a copy of the population (see Population.clone)
+        :param pop: the copy of the population
+        :return:
+        """
+        stats = copy.copy(self)
+        stats.pop = pop
+        stats.counts = self.counts.copy()
+        pop.observers.append(stats)
+        return stats
+
+    @staticmethod
+    def tally(pop: Population, idx: t.Union[int, np.ndarray, slice] = slice(None)) -> np.ndarray:
+        """
+        Count the people in each of the COUNTERS
+        :param pop: the population
+        :param idx: the people to count (default everyone)
+        :return: an array (size: COUNTERS) of counts
+        """
+        if not isinstance(idx, slice):
+            idx = np.atleast_1d(idx)
+        is_alive = pop.is_alive[idx]
+        was_sick = pop.covid_start[idx] != NO_DAY
+        has_ended = pop.covid_end[idx] != NO_DAY
+        adult = pop.age[idx] >= 18
+        work = pop.work[idx]
+        return np.array([
+            np.count_nonzero(is_alive),
+            np.count_nonzero(is_alive & was_sick & ~has_ended),
+            np.count_nonzero(is_alive & was_sick & has_ended),
+            np.count_nonzero(is_alive & ~was_sick),
+            np.count_nonzero(pop.is_vaccinated[idx]),
+            np.count_nonzero(pop.vaccine_wasted[idx]),
+            np.count_nonzero(was_sick & adult & (work == SCHOOL_ID)),
+            np.count_nonzero(was_sick & adult & (work == HOSPITAL_ID)),
+            np.count_nonzero(was_sick & adult & (work == FRONTLINE_ID)),
+        ], dtype=np.int64)
+
+    def before_change(self, idx: t.Union[int, np.ndarray]):
+        self.counts -= self.tally(self.pop, idx)
+
+    def after_change(self, idx: t.Union[int, np.ndarray]):
+        self.counts += self.tally(self.pop, idx)
+
+    def check(self):
+        """
+        Cross-check the running totals against a full scan of the population
+        :return:
+        """
+        scanned = self.tally(self.pop)
+        if not np.array_equal(scanned, self.counts):
+            wrong = {
+                name: (int(count), int(actual))
+                for name, count, actual in zip(self.COUNTERS, self.counts, scanned) if count != actual
+            }
+            raise AssertionError(f'City statistics are out of date (tracked, actual): {wrong}')
+
+    def count(self, name: str) -> int:
+        """
+        The current value of one of the COUNTERS
+        :param name:
+        :return:
+        """
+        if self.debug:
+            self.check()
+        return int(self.counts[self.COUNTERS.index(name)])
@@ -0,0 +1,352 @@
+from city import City
+from city_cache import CityCache, LOCATIONS, MATRICES
+from population import Population
+from report import create_summary_dictionary
+from runner import simulate
+from scenarios import LaneSimulation, Scenario
+from vaccine import NoVaccine, RandomVaccine
+from ai_vaccine import VaccineAI
+from features import feature_matrix
+from chance import ChanceTable, chance_table, TABLE_SIZE
+import settings
+from datetime import timedelta
+import itertools
+import numpy as np
+import pytest
+
+
+# The faster ways of running a city have to give the same results as the plain one. Small seeded cities, so these
+# run in a few seconds
+SIZE = 2000
+INITIAL_SICK = 40
+SEED = 7
+
+
+def assert_same_people(a: City, b: City):
+    for name in Population.DEMOGRAPHIC_COLUMNS + Population.STATE_COLUMNS:
+        assert np.array_equal(getattr(a.pop, name), getattr(b.pop, name)), name
+
+
+def assert_same_random_state(a: City, b: City):
+    assert a.random.getstate() == b.random.getstate()
+    assert a.rng.bit_generator.state == b.rng.bit_generator.state
+
+
+# Vectorized interactions ----------------------------------------------------------------------------------------------
+def test_vectorized_interactions_match_the_loops():
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    for _ in range(6):
+        sick_people = city.get_sick_people()
+        looped = np.zeros(len(city.pop), dtype=np.int64)
+        city.step1_work(looped, sick_people.tolist())
+        city.step2_home(looped, sick_people.tolist())
+        city.step3_shopping(looped, sick_people.tolist())
+        vectorized = city.contacts.interactions(city.pop, sick_people, city.active.quarantined.array())
+        assert np.array_equal(looped, vectorized)
+        city.run_days(10)
+
+
+
+# Running statistics ---------------------------------------------------------------------------------------------------
+def scanned_stats(city: City) -> dict:
+    """
+    The statistics counted one person at a time, as they were before CityStats
+    """
+    people = [city.pop[idx] for idx in range(len(city.pop))]
+    return {
+        'alive': sum(person.is_alive for person in people),
+        'sick': sum(person.is_currently_sick for person in people),
+        'recovered': sum(person.is_recovered for person in people),
+        'uninfected': sum(person.is_vulnerable for person in people),
+        'vaccinated': sum(person.is_vaccinated for person in people),
+        'wasted_vaccines': sum(person.vaccine_wasted for person in people),
+        'teachers_sick': sum(person.is_teacher and person.was_sick for person in people),
+        'hospital_workers_sick': sum(person.is_hospital_worker and person.was_sick for person in people),
+        'frontline_workers_sick': sum(person.is_frontline_worker and person.was_sick for person in people),
+    }
+
+
+def test_running_stats_match_a_scan():
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED, debug=True)
+    for day in range(60):
+        city.run_timestep()
+        if day == 20:
+            city.pop.vaccinate(np.arange(0, SIZE, 5))
+            city.pop.kill(city.get_sick_people()[::4], city.current_day)
+            hospital_workers = np.flatnonzero((city.pop.work == settings.HOSPITAL_ID) & (city.pop.age >= 18))
+            city.pop.infect(hospital_workers[:2], city.current_day)
+        if day % 10 == 0:
+            # every count is also checked against CityStats.tally, since the city is in debug mode
+            assert {name: city.stats.count(name) for name in city.stats.COUNTERS} == scanned_stats(city)
+    assert all(count > 0 for count in scanned_stats(city).values())
+
+
+def test_debug_city_catches_stale_stats():
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED, debug=True)
+    city.run_days(5)
+    city.stats.count('alive')
+    # changing a column directly skips the observers, so the running totals still count this person
+    city.pop.is_alive[0] = False
+    with pytest.raises(AssertionError):
+        city.stats.count('alive')
+
+# Active cases -------------------------------------------------------------------------------------------------------
+def test_active_cases_follow_the_population():
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED, debug=True)
+    for _ in range(40):
+        city.run_timestep()
+        assert np.array_equal(np.sort(city.get_sick_people()), np.flatnonzero(city.pop.is_contagious))
+
+
+def test_debug_city_catches_a_stale_active_index():
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED, debug=True)
+    city.run_days(5)
+    city.get_sick_people()
+    # changing a column directly skips the observers, so the index still has this person as sick
+    person = city.get_sick_people()[0]
+    city.pop.is_alive[person] = False
+    with pytest.raises(AssertionError):
+        city.get_sick_people()
+
+
+# Partitioned runs -----------------------------------------------------------------------------------------------------
+def test_partitioned_run_matches_one_process():
+    single = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    partitioned = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    with partitioned.partition(2):
+        for _ in range(60):
+            single.run_timestep()
+            partitioned.run_timestep()
+            assert create_summary_dictionary(single) == create_summary_dictionary(partitioned)
+    assert_same_people(single, partitioned)
+    assert_same_random_state(single, partitioned)
+
+
+# Checkpoints ----------------------------------------------------------------------------------------------------------
+def test_resumed_run_matches_uninterrupted(tmp_path):
+    days = 90
+    checkpoint = tmp_path / 'test.npz'
+    uninterrupted = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    expected = list(simulate(uninterrupted, days))
+
+    # stop part way, after the checkpoint on day 20 was saved (while people are still getting sick)
+    stopped = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    list(itertools.islice(simulate(stopped, days, checkpoint=checkpoint, checkpoint_every=10), 25))
+    assert checkpoint.exists()
+
+    resumed = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    assert list(simulate(resumed, days, checkpoint=checkpoint, checkpoint_every=10)) == expected
+    assert_same_people(uninterrupted, resumed)
+    assert_same_random_state(uninterrupted, resumed)
+
+
+def test_resumed_run_keeps_its_vaccine_schedule(tmp_path):
+    days = 60
+    checkpoint = tmp_path / 'test.npz'
+
+    def vaccinated_city() -> City:
+        city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+        RandomVaccine('random').assign_scores(city)
+        return city
+
+    uninterrupted = vaccinated_city()
+    start = uninterrupted.start_date
+    schedule = {start + timedelta(days=3): 300, start + timedelta(days=25): 500, start + timedelta(days=40): 100}
+    uninterrupted.set_vaccine_schedule(schedule)
+    expected = list(simulate(uninterrupted, days))
+
+    stopped = vaccinated_city()
+    stopped.set_vaccine_schedule(schedule)
+    list(itertools.islice(simulate(stopped, days, checkpoint=checkpoint, checkpoint_every=10), 15))
+
+    # the schedule comes from the checkpoint, not from whoever carries on the run
+    resumed = vaccinated_city()
+    assert list(simulate(resumed, days, checkpoint=checkpoint, checkpoint_every=10)) == expected
+    assert resumed.vaccine_doses == schedule
+    assert_same_people(uninterrupted, resumed)
+
+
+def test_checkpoint_from_another_build_is_ignored(tmp_path):
+    days = 30
+    checkpoint = tmp_path / 'test.npz'
+    other = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, bulk=False, seed=SEED)
+    list(itertools.islice(simulate(other, days, checkpoint=checkpoint, checkpoint_every=10), 15))
+
+    expected = list(simulate(City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED), days))
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    assert list(simulate(city, days, checkpoint=checkpoint, checkpoint_every=10)) == expected
+
+
+def test_checkpoint_from_another_seed_is_ignored(tmp_path):
+    days = 60
+    checkpoint = tmp_path / 'test.npz'
+    other = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED + 1)
+    list(itertools.islice(simulate(other, days, checkpoint=checkpoint, checkpoint_every=10), 30))
+
+    expected = list(simulate(City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED), days))
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    assert list(simulate(city, days, checkpoint=checkpoint, checkpoint_every=10)) == expected
+
+
+# City cache -----------------------------------------------------------------------------------------------------------
+def test_cached_city_matches_fresh_build(tmp_path):
+    cache = CityCache(tmp_path)
+    for vectorized in (False, True):
+        fresh = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=vectorized, seed=SEED)
+        City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=vectorized, seed=SEED, cache=cache)
+        cached = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=vectorized, seed=SEED, cache=cache)
+        assert isinstance(cached.pop.age, np.memmap)
+
+        assert_same_people(fresh, cached)
+        assert_same_random_state(fresh, cached)
+        for name in LOCATIONS:
+            index, cached_index = getattr(fresh, name), getattr(cached, name)
+            assert index.first_id == cached_index.first_id
+            assert np.array_equal(index.offsets, cached_index.offsets)
+            assert np.array_equal(index.members, cached_index.members)
+        for name in MATRICES:
+            assert (getattr(fresh.contacts, name) != getattr(cached.contacts, name)).nnz == 0
+
+        assert list(simulate(fresh, 90)) == list(simulate(cached, 90))
+        assert_same_people(fresh, cached)
+
+
+# Scenarios ------------------------------------------------------------------------------------------------------------
+def test_default_lane_starts_like_the_city():
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK * 5, vectorized=True, seed=SEED)
+    vaccine = NoVaccine('none')
+    lanes = LaneSimulation(city, [Scenario(vaccine), Scenario(vaccine, recovery_rate_stage_0=0.0)],
+                           {'none': city.pop.vaccine_score}, np.random.default_rng(SEED))
+    for name in LaneSimulation.STATE_COLUMNS:
+        assert np.array_equal(getattr(lanes, name)[:, 0], getattr(city.pop, name)), name
+
+    # the other lane went through the days before the start with its own recovery rates: nobody got better on the
+    # day stage 0 ends
+    initially_sick = np.flatnonzero(city.pop.initially_sick)
+    stage_0_day = Population.STAGE_DAYS[2]
+    assert np.any(city.pop.covid_end[initially_sick] - city.pop.covid_start[initially_sick] == stage_0_day)
+    days_sick = lanes.covid_end[initially_sick, 1] - lanes.covid_start[initially_sick, 1]
+    assert not np.any(days_sick == stage_0_day)
+    assert np.any(lanes.sickness_level[initially_sick, 1] > 0)
+
+
+# Vaccines -------------------------------------------------------------------------------------------------------------
+def test_vaccines_go_to_the_first_eligible_people_on_each_date():
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    RandomVaccine('random').assign_scores(city)
+    rng = np.random.default_rng(SEED)
+    city.pop.vaccine_score[rng.choice(SIZE, 200, replace=False)] = -1     # not to be vaccinated
+    start = city.start_date
+    doses = [150, 400, 0, 300, 2000, 100]
+    city.set_vaccine_schedule({start + timedelta(days=day + 1): count for day, count in enumerate(doses)})
+    order = np.argsort(city.pop.vaccine_score, kind='stable')
+
+    for vaccine_date in city.vaccine_dates:
+        # people who die or are vaccinated some other way between the dates are passed over
+        city.pop.kill(rng.choice(SIZE, 30, replace=False), city.current_day)
+        city.pop.vaccinate(rng.choice(SIZE, 10, replace=False))
+
+        # what walking the whole order from the start would give
+        pop = city.pop
+        eligible = order[pop.is_alive[order] & ~pop.is_vaccinated[order] & (pop.vaccine_score[order] >= 0)]
+        expected = eligible[:city.vaccine_doses[vaccine_date]]
+
+        was_vaccinated = pop.is_vaccinated.copy()
+        city.current_date = vaccine_date
+        city.step4_vaccine()
+        assert np.array_equal(np.flatnonzero(pop.is_vaccinated & ~was_vaccinated), np.sort(expected))
+
+    # the date with more doses than people left vaccinated everyone left, and its unused doses went nowhere
+    pop = city.pop
+    assert not np.any(pop.is_alive & ~pop.is_vaccinated & (pop.vaccine_score >= 0))
+    assert city.vaccine_cursor == len(order)
+
+
+# Chance of getting covid ----------------------------------------------------------------------------------------------
+def closed_form_chance(interactions: np.ndarray, age: int, preexisting_condition: bool,
+                       covid_immunity: float) -> np.ndarray:
+    """
+    The chance of getting covid as it was worked out before the table (see ChanceTable)
+    """
+    probability = np.power(1 + settings.CHANGE_OF_GETTING_SICK_FROM_INTERACTION, interactions) - 1
+    probability *= 2.0 if age >= 70 else 1.5 if age >= 50 else 1.1 if age >= 30 else 1.0
+    probability *= 2.0 if preexisting_condition else 1.0
+    return probability * (1 - covid_immunity)
+
+
+RISK_GROUPS = [(age, preexisting_condition) for age in (10, 29, 30, 49, 50, 69, 70, 90)
+               for preexisting_condition in (False, True)]
+
+
+def assert_table_matches(table: ChanceTable, size: int):
+    # every count up to past the end of the table, including the ones that aren't a multiple of the step
+    interactions = np.arange(size * table.step + 3 * table.step + 1)
+    for age, preexisting_condition in RISK_GROUPS:
+        for covid_immunity in (0.0, 0.5):
+            looked_up = table.lookup(interactions, np.full(len(interactions), age),
+                                     np.full(len(interactions), preexisting_condition),
+                                     np.full(len(interactions), covid_immunity))
+            expected = closed_form_chance(interactions, age, preexisting_condition, covid_immunity)
+            np.testing.assert_allclose(looked_up, expected, rtol=1e-8, atol=0)
+            one_at_a_time = [table.chance(n, age, preexisting_condition, covid_immunity)
+                             for n in interactions.tolist()]
+            assert np.array_equal(np.array(one_at_a_time), looked_up)
+
+
+def test_chance_table_matches_the_formula():
+    interactions = (settings.WORK_INTERACTIONS, settings.HOME_INTERACTIONS, settings.SHOPPING_INTERACTIONS)
+    assert_table_matches(ChanceTable(settings.CHANGE_OF_GETTING_SICK_FROM_INTERACTION, interactions, size=64), 64)
+
+    # the shared table, used by Person and Population
+    table = chance_table()
+    interactions = np.arange(TABLE_SIZE * table.step + 3 * table.step + 1)
+    for age, preexisting_condition in RISK_GROUPS:
+        looked_up = table.lookup(interactions, np.full(len(interactions), age),
+                                 np.full(len(interactions), preexisting_condition), np.zeros(len(interactions)))
+        np.testing.assert_allclose(looked_up, closed_form_chance(interactions, age, preexisting_condition, 0.0),
+                                   rtol=1e-8, atol=0)
+
+
+def test_person_and_population_share_the_chance():
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    city.run_days(10)
+    interactions = np.random.default_rng(SEED).integers(0, 3000, SIZE)
+    probability = city.pop.chance_of_getting_covid(interactions)
+    for idx in range(0, SIZE, 7):
+        assert city.pop[idx].chance_of_getting_covid(int(interactions[idx])) == probability[idx]
+
+
+def test_chance_table_follows_the_settings(monkeypatch):
+    before = chance_table()
+    monkeypatch.setattr(settings, 'CHANGE_OF_GETTING_SICK_FROM_INTERACTION', 1e-4)
+    monkeypatch.setattr(settings, 'WORK_INTERACTIONS', 7)     # the counts aren't all multiples of 5 any more
+    table = chance_table()
+    assert table is not before
+    assert table.step == 1
+    assert_table_matches(table, 64)
+    person = City('test', size=100, initial_sick=5, seed=SEED).pop[0]
+    assert person.chance_of_getting_covid(333) == pytest.approx(
+        float(closed_form_chance(np.array(333), person.age, person.preexisting_condition, person.covid_immunity)),
+        rel=1e-8)
+
+
+# VaccineAI inputs -----------------------------------------------------------------------------------------------------
+def test_default_features_are_the_old_inputs():
+    city = City('test', size=SIZE, initial_sick=INITIAL_SICK, vectorized=True, seed=SEED)
+    city.run_days(60)
+    # nobody dies this early, so some of the sick do
+    sick = np.flatnonzero(city.pop.was_sick & ~city.pop.initially_sick)
+    city.pop.kill(sick[::3], 60)
+    vaccine = VaccineAI('test')
+
+    # the inputs and labels as they were built one person at a time
+    people = [city.pop[idx] for idx in range(SIZE)]
+    inputs = np.array([[float(person.age), person.is_teacher, person.is_frontline_worker, person.is_hospital_worker,
+                        person.preexisting_condition, len(person.shopping)] for person in people], dtype=np.float32)
+    actual = np.array([0 if person.initially_sick else 2 if not person.is_alive else 1 if person.was_sick else -1
+                       for person in people], dtype=np.float32)
+    assert set(actual.tolist()) == {0, 2, 1, -1}
+
+    assert np.array_equal(vaccine.get_inputs(city).numpy(), inputs)
+    assert np.array_equal(vaccine.get_actual(city).numpy(), actual)
+    assert np.array_equal(feature_matrix(city, people=slice(123, 456)), inputs[123:456])
@@ -31,6 +31,11 @@ class RandomVaccine(VaccineBase):
     def __init__(self, vaccine_name: str):
         super().__init__(vaccine_name)
 
-    def assign_person_score(self, person: Person):
+    def assign_scores(self, city: City):
+        # Draw from the city's random numbers, so a seeded city gets the same scores every time
+        for p in city.pop:
+            self.assign_person_score(p, rand=city.random)
+
+    def assign_person_score(self, person: Person, rand: random.Random = random):
         # Give everyone a random score (ie. first-come, first-served)
-        person.vaccine_score = random.random()
+        person.vaccine_score = rand.random()